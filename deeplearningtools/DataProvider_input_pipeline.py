@@ -26,36 +26,55 @@ try:
 except Exception as e:
   print('WARNING, could not load the rasterio library, this will impact your data pipeline if willing to use it. Error report:', e)
 
+try:
+  import numba
+except Exception as e:
+  numba=None
+  print('WARNING, could not load the numba library, samples entropies will be computed with numpy only. Error report:', e)
+
+import functools
 import matplotlib.pyplot as plt
-import glob
 import os
+import pathlib
 import numpy as np
-import copy
 import tensorflow as tf
 import unicodedata
 
 dataprovider_namescope="data_input_pipeline"
-filenames_separator='###'
+# minimum batch size from which get_samples_entropies relies on the numba parallel implementation (if available)
+numba_entropies_min_batch_size=32
+# image file formats decoded by Tensorflow native ops, other formats are read by the selected alternative reader
+tf_native_image_formats='(?i).*\\.(jpe?g|png|bmp|gif)'
 
-def image_tfrecords_dataset(filename, hasLabels=False, dtype=tf.float32):
+def image_tfrecords_dataset(filename, hasLabels=False, dtype=tf.float32, deterministic=True):
   """
   Assuming a set of tfrecords file is pointed by filename, ex:'images.tfrecords',
   create a data provider that loads them for training/testing models.
 
-  :param filename: A path to the tfrecord files
-  :type filename: str
+  Each record is expected to store the image shape ('height', 'width', 'depth' int64 features)
+  and the image pixels as a single raw bytes string ('image_raw', ex: numpy_array.tobytes()) of type dtype.
+
+  :param filename: A path to the tfrecord files, a glob pattern (ex:'images_*.tfrecords') or a list of paths, shards are read in parallel
+  :type filename: str or list
   :type haslabel: A boolean, false by default that specifies if an iteger label is expected or not.
+  :param dtype: The pixels data type used when writing the records.
+  :param deterministic: Set False to let records come in any order from the shards (faster), True to keep the file order.
 
   :return: A tf.data.Dataset WITHOUT PREFETCH NOR BATCH, specify your own.
   """
-  raw_image_dataset = tf.data.TFRecordDataset(filename)
+  # read the shards in parallel, each one with a large read buffer : records are read as big sequential chunks
+  files_dataset = tf.data.Dataset.list_files(filename, shuffle=False)
+  raw_image_dataset = files_dataset.interleave(lambda shard: tf.data.TFRecordDataset(shard, buffer_size=8<<20),
+                                               cycle_length=tf.data.AUTOTUNE,
+                                               num_parallel_calls=tf.data.AUTOTUNE,
+                                               deterministic=deterministic)
 
   # Create a dictionary describing the features.
   image_feature_description = {
       'height': tf.io.FixedLenFeature([], tf.int64),
       'width': tf.io.FixedLenFeature([], tf.int64),
       'depth': tf.io.FixedLenFeature([], tf.int64),
-      'image_raw': tf.io.VarLenFeature(dtype),
+      'image_raw': tf.io.FixedLenFeature([], tf.string),
   }
   if hasLabels:
     image_feature_description.update({'label': tf.io.FixedLenFeature([], tf.int64)})
@@ -63,10 +82,12 @@ def image_tfrecords_dataset(filename, hasLabels=False, dtype=tf.float32):
   def _parse_image_function(example_proto):
     # Parse the input tf.Example proto using the dictionary above.
     flat_sample=tf.io.parse_single_example(example_proto, image_feature_description)
-    sample=tf.reshape(tf.sparse.to_dense(flat_sample['image_raw']), (flat_sample['height'], flat_sample['width'], flat_sample['depth']))
+    # dense pixels buffer, directly decoded, no sparse tensor involved
+    pixels=tf.io.decode_raw(flat_sample['image_raw'], out_type=dtype)
+    sample=tf.reshape(pixels, (flat_sample['height'], flat_sample['width'], flat_sample['depth']))
     return sample
 
-  return raw_image_dataset.map(_parse_image_function)
+  return raw_image_dataset.map(_parse_image_function, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
 
 def test_image_tfrecords_dataset(filename='test_dataset.tfrecords'):
   """  
@@ -122,24 +143,13 @@ def make_images_coarse(input_images, downscale_factor=2):
 
     :return: A batch of images of the same size as the input but made coarser spatially.
     """
-    #downscale first
-    init_height=input_images.get_shape().as_list()[1]
-    init_width=input_images.get_shape().as_list()[2]
-    new_height=init_height/downscale_factor
-    new_width=init_width/downscale_factor
-    downscaled=tf.image.resize_nearest_neighbor(
-                                        input_images,
-                                        size=[new_height, new_width],
-                                        align_corners=True,
-                                        name='reference_downscale'
-                                    )
-    #upscals back to initial resolution
-    coarse_reference=tf.image.resize_nearest_neighbor(
-                                        downscaled,
-                                        size=[init_height, init_width],
-                                        align_corners=True,
-                                        name='reference_coarse'
-                                    )
+    #downscale first : nearest neighbors subsampling is a plain strided slice
+    downscaled=input_images[:, ::downscale_factor, ::downscale_factor, :]
+    #upscale back to initial resolution : each subsampled pixel is duplicated downscale_factor times along each axis
+    coarse_reference=tf.repeat(tf.repeat(downscaled, downscale_factor, axis=1), downscale_factor, axis=2)
+    #crop back to the input size (if not a multiple of the downscaling factor)
+    input_shape=tf.shape(input_images)
+    coarse_reference=tf.identity(coarse_reference[:, :input_shape[1], :input_shape[2], :], name='reference_coarse')
 
     return coarse_reference
 
@@ -171,18 +181,19 @@ def scaleImg_0_255(img):
     """
     #get the mask value
     print('Rescaling array of type:'+str(img.dtype))
-    #copying before modifying
-    img_copy=copy.deepcopy(img)
-    try:
-        maskValue=np.iinfo(img_copy.dtype).min
-        #replace mask values by zeros
-        img_copy[img_copy==maskValue]=0
-    except Exception as e:
-        print('Failed to detect data type, if float value, then, following should run fine. Error report:', e)
+    if np.issubdtype(img.dtype, np.integer):
+        maskValue=np.iinfo(img.dtype).min
+        #replace mask values by zeros, out of place, input remains untouched
+        img_copy=np.where(img==maskValue, 0, img)
+    else:
+        #no mask value for float data, the rescaling below never writes to the input
+        img_copy=img
     img_min=np.nanmin(img_copy)
     img_max=np.nanmax(img_copy)
     epsilon=1e-4
-    scaled_img=((img_copy-img_min)*255.0)/(img_max-img_min+epsilon)
+    #rescale with a single output buffer, no intermediate temporaries
+    scaled_img=np.subtract(img_copy, img_min, dtype=np.result_type(img_copy, 255.0))
+    np.multiply(scaled_img, 255.0/(img_max-img_min+epsilon), out=scaled_img)
     scaled_img[np.isnan(scaled_img)]=0
     return scaled_img
 
@@ -211,18 +222,15 @@ def extractFilenames(root_dir, file_extension="*.jpg", raiseOnEmpty=True):
     :type file_extension:
     :param raiseOnEmpty: A boolean, set True if an exception should be raised if no file is found
     """
-    files  = []
     msg='extractFilenames: from working directory {wd}, looking for files {path} with extension {ext}'.format(wd=os.getcwd(),
                                                                                                                 path=root_dir,
                                                                                                                 ext=file_extension)
     print(msg)
-    for root, dirnames, filenames in os.walk(root_dir):
-        file_proto=os.path.join(root, file_extension)
-        print('-> Parsing folder : '+file_proto)
-        newfiles = glob.glob(file_proto)
-        if len(newfiles)>0:
-            print('----> Found files:'+str(len(newfiles)))
-        files.extend(newfiles)
+    #single recursive directory walk, each folder is listed only once
+    #hidden files and files under hidden folders (relative to root_dir) are skipped
+    root_path = pathlib.Path(root_dir)
+    files = [str(path) for path in root_path.rglob(file_extension)
+             if path.is_file() and not any(part.startswith('.') for part in path.relative_to(root_path).parts)]
 
     if len(files)==0 and raiseOnEmpty is True:
         raise ValueError('No files found at '+msg)
@@ -233,22 +241,20 @@ def extractFilenames(root_dir, file_extension="*.jpg", raiseOnEmpty=True):
 def the_ugly_string_manager(filename):
   """
   Horribly ugly code to ensure that a filename string complies with gdal and opencv 
-  when dealing with python 2 or 3 and pure python or tensorflow py_function.
+  when dealing with python 2 or 3 and pure python or tensorflow py_function/numpy_function.
   
   Convert to input to unicode to recover properly to string.
 
   FIXME : ... maybe just wait for the death of python2 and hope for a more elegant python3... but still waiting...
   """
-  #tf.print('filename=',filename)
-  #tf.print('dtype=', filename.dtype)
   if isinstance(filename, tf.Tensor):
       filename=filename.numpy()
-  if not(isinstance(filename, bytes)):
-      filename=bytes(filename, 'utf-8')
-  filename_str=unicodedata.normalize('NFC', str(filename))
-  if filename_str[0]=='b':
-    filename_str=filename_str[2:-1]
-  return filename_str
+  if isinstance(filename, np.ndarray):
+      # 0-d array, as received from tf.numpy_function called eagerly
+      filename=filename.item()
+  if isinstance(filename, bytes):
+      filename=filename.decode('utf-8')
+  return unicodedata.normalize('NFC', filename)
 
 def imread_from_rasterio(filename, debug_mode=False):
   """
@@ -263,18 +269,14 @@ def imread_from_rasterio(filename, debug_mode=False):
   filename_str=the_ugly_string_manager(filename)
 
   with rasterio.open(filename_str, 'r') as ds:
-    arr = ds.read()  # read all raster values
+    # read all raster values in a single pass, directly as float32 into a (height, width, bands) buffer
+    # (the bands first transposed view makes rasterio write each band as an interleaved plane)
+    img_array=np.empty((ds.height, ds.width, ds.count), dtype=np.float32)
+    ds.read(out=img_array.transpose([2,0,1]))
 
-    if arr is None:
-      raise ValueError('Could no read file {file}, exists={exists}'.format(file=filename_str,
-                                                                           exists=os.path.exists(filename_str)
-                                                                           )
-                      )
-  raster_array=arr.transpose([1,2,0])
   if debug_mode is True:
-      print('Reading image with GDAL : {file}'.format(file=filename_str))
-      print('Image shape='+str(raster_array.shape))
-  img_array=raster_array.astype(np.float32)
+      print('Reading image with rasterio : {file}'.format(file=filename_str))
+      print('Image shape='+str(img_array.shape))
 
   return img_array
 
@@ -296,13 +298,15 @@ def imread_from_gdal(filename, debug_mode=False):
                                                                          exists=os.path.exists(filename_str)
                                                                          )
                     )
-  raster_array=ds.ReadAsArray().transpose([1,2,0])
+  # read each band directly as float32 into its plane of a (height, width, bands) buffer
+  img_array=np.empty((ds.RasterYSize, ds.RasterXSize, ds.RasterCount), dtype=np.float32)
+  for band_id in range(ds.RasterCount):
+    ds.GetRasterBand(band_id+1).ReadAsArray(buf_obj=img_array[:,:,band_id])
 
   del ds #finally free memory...
   if debug_mode is True:
       print('Reading image with GDAL : {file}'.format(file=filename_str))
-      print('Image shape='+str(raster_array.shape))
-  img_array=raster_array.astype(np.float32)
+      print('Image shape='+str(img_array.shape))
 
   return img_array
 
@@ -324,10 +328,8 @@ def imread_from_opencv(filename, cv_imreadMode):
   """
   #get a valid filename string
   filename_str=the_ugly_string_manager(filename)
-  #print("cv_imreadMode type is int", isinstance(cv_imreadMode, int))
-  if not(isinstance(cv_imreadMode, int)):
-    cv_imreadMode=cv_imreadMode.numpy()
-  image=cv2.imread(filename_str, cv_imreadMode)
+  #flags may come as a numpy scalar when called through tf.numpy_function
+  image=cv2.imread(filename_str, int(cv_imreadMode))
   if not(isinstance(image, np.ndarray)):
       raise ValueError('Could no read file {file}, exists={exists}'.format(file=filename_str,
                                                                            exists=os.path.exists(str(filename))
@@ -342,22 +344,198 @@ def imread_from_opencv(filename, cv_imreadMode):
   """
   if len(image.shape)==3: ##reorder channels, from the loaded opencv BGR to tensorflow RGB use
     if image.shape[2]==3:
-        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        # reversed channels view, no copy here, the single copy is the float32 conversion below
+        image=image[..., ::-1]
+  # tf.numpy_function expects the exact declared output type
+  return image.astype(np.float32, copy=False)
+
+def imread_from_tf(filename, channels=0):
+  """
+  Read an image using Tensorflow native decoders, the image remains in the tensorflow graph.
+
+  Supported formats are those of tf.io.decode_image (jpeg, png, bmp, gif), channels are in the RGB order.
+  16 bits png files (high bit depth rasters, label maps with many classes) are decoded as uint16 to keep their full values.
+
+  :param filename: A scalar string tensor, the image file path.
+  :param channels: The number of expected channels, 0 to keep the channels of the image file.
+
+  :return: A float32 tensor of shape (height, width, channels).
+  """
+  contents=tf.io.read_file(filename)
+  # png signature then IHDR chunk, the bit depth is byte 24 (header padded for files shorter than a png header)
+  header=tf.strings.join([tf.strings.substr(contents, 0, 25), b'\0'*25])
+  is_16bits_png=tf.logical_and(tf.equal(tf.strings.substr(header, 0, 8), b'\x89PNG\r\n\x1a\n'),
+                               tf.equal(tf.strings.substr(header, 24, 1), b'\x10'))
+  image=tf.cond(is_16bits_png,
+                true_fn=lambda: tf.cast(tf.io.decode_png(contents, channels=channels, dtype=tf.uint16), dtype=tf.float32),
+                false_fn=lambda: tf.cast(tf.io.decode_image(contents, channels=channels, expand_animations=False), dtype=tf.float32))
   return image
 
+def imread_with_fallback(filename, fallback_imread_fn=None, channels=0):
+  """
+  Read an image with Tensorflow native decoders if its format allows it (see tf_native_image_formats),
+  else call an alternative reader such as a tf.numpy_function wrapping imread_from_opencv, imread_from_gdal or imread_from_rasterio.
+
+  Avoiding the python readers on standard formats removes the python/GIL round trip so that image decoding
+  can actually be parallelized by tf.data.
+
+  :param filename: A scalar string tensor, the image file path.
+  :param fallback_imread_fn: A function that takes the filename tensor and returns a float32 image tensor, None to use Tensorflow decoders only.
+  :param channels: The number of expected channels when decoding with Tensorflow, 0 to keep the channels of the image file.
+
+  :return: A float32 tensor of shape (height, width, channels).
+  """
+  if fallback_imread_fn is None:
+    image=imread_from_tf(filename, channels)
+  else:
+    image=tf.cond(tf.strings.regex_full_match(filename, tf_native_image_formats),
+                  true_fn=lambda: imread_from_tf(filename, channels),
+                  false_fn=lambda: fallback_imread_fn(filename))
+  # ensure a rank 3 tensor (height, width, channels) whatever the reader used (gray images may be loaded as 2D arrays)
+  return tf.reshape(image, [tf.shape(image)[0], tf.shape(image)[1], -1])
+
+def standardize_images(images):
+  """
+  Per image standardization, same result as tf.image.per_image_standardization
+  (zero mean and unit variance, standard deviation lower bounded by 1/sqrt(nb values)).
+
+  Mean and variance are computed in a single moments op and applied by a multiply with rsqrt
+  so that the whole op can be fused with its neighbors, it also directly applies on batches.
+
+  :param images: A float tensor, a single image (height, width, channels) or a batch of images (batch, height, width, channels).
+
+  :return: The standardized images, same shape and type as the input.
+  """
+  with tf.name_scope('standardize_images'):
+      mean, variance=tf.nn.moments(images, axes=[-3,-2,-1], keepdims=True)
+      nb_values=tf.cast(tf.reduce_prod(tf.shape(images)[-3:]), dtype=images.dtype)
+      return (images-mean)*tf.math.rsqrt(tf.maximum(variance, 1.0/nb_values))
+
+def get_imread_fallback_fn(alternative_imread, opencv_read_flags=-1):
+  """
+  Get a graph compatible image reading function relying on one of the python image readers.
+
+  :param alternative_imread: The image reader name, 'opencv', 'gdal' or 'rasterio', any other value means Tensorflow readers only.
+  :param opencv_read_flags: The cv2.imread flags used if relying on OpenCV.
+
+  :return: A function that takes a filename tensor and returns a float32 image tensor (through tf.numpy_function), None if no alternative reader is selected.
+  """
+  # tf.numpy_function : readers directly get numpy values (bytes filename), no eager tensors wrapping
+  if alternative_imread == 'opencv':
+    # use Opencv image reading methods WARNING, take care of the channels order that may change !!!
+    return lambda filename: tf.numpy_function(imread_from_opencv, [filename, opencv_read_flags], tf.float32)
+  elif alternative_imread == 'gdal':
+    # use gdal image reading methods WARNING, take care of the channels order that may change !!!
+    return lambda filename: tf.numpy_function(imread_from_gdal, [filename], tf.float32)
+  elif alternative_imread == 'rasterio':
+    # use rasterio image reading methods WARNING, take care of the channels order that may change !!!
+    return lambda filename: tf.numpy_function(imread_from_rasterio, [filename], tf.float32)
+  # else: use Tensorflow image reading methods only
+  return None
+
+@tf.function
+def replace_nans_by_zeros(samples):
+  """
+  Replace nan values by zeros in a single pass.
+
+  :param samples: A tensor of any shape.
+
+  :return: The input tensor with nan values replaced by zeros.
+  """
+  return tf.where(tf.math.is_nan(samples), tf.constant(0, dtype=samples.dtype), samples)
+
+def get_crops_filter(crop_filter):
+  """
+  Vectorize a crop filter function so that it selects crops from a batch of crops.
+
+  :param crop_filter: A function that takes a single crop tensor and returns True if the crop should be kept.
+
+  :return: A function that takes a [nb_crops, height, width, channels] tensor and returns a boolean vector of size nb_crops.
+  """
+  return lambda crops: tf.vectorized_map(crop_filter, crops, fallback_to_while_loop=True)
+
+def compose_image_transforms(transforms, jit_compile=False):
+  """
+  Compose a list of image transforms into a single tf.function.
+
+  :param transforms: A list of functions f(images, seed) that return the transformed images.
+  :param jit_compile: Set True to compile the composed transforms with XLA, all the transforms ops must then be XLA compatible.
+
+  :return: A tf.function g(images, seeds) that applies all the transforms in order, the i-th transform using seeds[i].
+  """
+  @tf.function(jit_compile=jit_compile)
+  def composed_transforms(images, seeds):
+    return functools.reduce(lambda transformed_images, transform_id: transforms[transform_id](transformed_images, seeds[transform_id]),
+                            range(len(transforms)),
+                            images)
+  return composed_transforms
+
+# image loading tf.functions shared by all the data providers with the same reading setup, traced once
+images_loaders_cache={}
+
+def get_raw_ref_images_loader(alternative_imread, opencv_read_flags, raw_depth, reference_depth):
+  """
+  Get the tf.function that loads a raw image and its reference image from separate files and concatenates them.
+
+  :param alternative_imread: The alternative image reader name ('opencv', 'gdal', 'rasterio') used for non standard image formats, else Tensorflow readers only.
+  :param opencv_read_flags: The cv2.imread flags used to read the raw images if relying on OpenCV.
+  :param raw_depth: The number of channels of the raw images.
+  :param reference_depth: The number of channels of the reference images.
+
+  :return: A tf.function that takes the raw and the reference filenames and returns the concatenated image.
+  """
+  loader_key=('raw_ref_images', alternative_imread, opencv_read_flags, raw_depth, reference_depth)
+  if loader_key not in images_loaders_cache:
+    raw_imread_fn=get_imread_fallback_fn(alternative_imread, opencv_read_flags)
+    reference_imread_fn=get_imread_fallback_fn(alternative_imread, 0)#cv2.IMREAD_GRAYSCALE=0
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string), tf.TensorSpec(shape=[], dtype=tf.string)])
+    def load_raw_ref_images(raw_img_filename, ref_img_filename):
+      raw_image=imread_with_fallback(raw_img_filename, raw_imread_fn, channels=raw_depth)
+      reference_image=imread_with_fallback(ref_img_filename, reference_imread_fn, channels=reference_depth)
+      #concatenate both images in a single one
+      return tf.concat([raw_image, reference_image], axis=2, name='concat_inputs')
+
+    images_loaders_cache[loader_key]=load_raw_ref_images
+  return images_loaders_cache[loader_key]
+
+def get_raw_ref_image_loader(alternative_imread, opencv_read_flags):
+  """
+  Get the tf.function that loads a single image file with its reference as the last channel(s).
+
+  :param alternative_imread: The alternative image reader name ('opencv', 'gdal', 'rasterio') used for non standard image formats.
+  :param opencv_read_flags: The cv2.imread flags used if relying on OpenCV.
+
+  :return: A tf.function that takes the image filename and returns the image with all its channels.
+  """
+  loader_key=('raw_ref_image', alternative_imread, opencv_read_flags)
+  if loader_key not in images_loaders_cache:
+    imread_fn=get_imread_fallback_fn(alternative_imread, opencv_read_flags)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
+    def load_raw_ref_image(raw_img_filename):
+      # channels=0 : keep all the image channels as stored, reference being the last one
+      return imread_with_fallback(raw_img_filename, imread_fn, channels=0)
+
+    images_loaders_cache[loader_key]=load_raw_ref_image
+  return images_loaders_cache[loader_key]
+
 @tf.function
 def normalised_entropy(counts):
   """
   Calculates the normalized entropy based on the counts of different classes.
 
-  :param counts: A tensor representing the counts of each class.
+  :param counts: A tensor representing the counts of each class (last axis), can be a batch of counts.
 
-  :return: entropy_normalized: The normalized entropy value.
+  :return: entropy_normalized: The normalized entropy value(s), one per counts vector.
   """
-  classes_prob=tf.math.divide(tf.cast(counts, dtype=tf.float32), tf.cast(tf.reduce_sum(counts), dtype=tf.float32))
+  classes_prob=tf.math.divide(tf.cast(counts, dtype=tf.float32), tf.cast(tf.reduce_sum(counts, axis=-1, keepdims=True), dtype=tf.float32))
   #tf.print('classes_prob', [classes_prob], summarize=-1)
-  entropy= -tf.reduce_sum(classes_prob*tf.math.log(classes_prob+0.001))
-  entropy_normalized=tf.math.divide(entropy,tf.math.log(0.001+tf.cast(tf.math.count_nonzero(counts), dtype=tf.float32)))
+  # xlogy(p, p) is exactly 0 for empty classes, no epsilon bias
+  entropy= -tf.reduce_sum(tf.math.xlogy(classes_prob, classes_prob), axis=-1)
+  nb_present_classes=tf.cast(tf.math.count_nonzero(counts, axis=-1), dtype=tf.float32)
+  # single class counts : null entropy, avoid dividing by log(1)=0
+  entropy_normalized=tf.math.divide(entropy, tf.where(nb_present_classes>1, tf.math.log(nb_present_classes), 1.0))
   return entropy_normalized
 
 @tf.function
@@ -372,6 +550,24 @@ def get_sample_entropy_int(sample):
       counts=tf.histogram_fixed_width(tf.cast(sample, dtype=tf.int32), value_range=[0, 255], nbins=256, dtype=tf.int32)
       return normalised_entropy(counts)
 
+@tf.function
+def get_sample_entropies_int_batched(samples_batch):
+  """
+  Batched version of get_sample_entropy_int, all the samples histograms are computed by a single bincount.
+
+  :param samples_batch: A batch of samples (first axis) with values expected in the range [0, 255].
+
+  :return: The vector of size (batchsize) with sample entropy values.
+  """
+  with tf.name_scope('samples_entropies_int'):
+      # explicit sample size (no -1) to support empty batches
+      samples_shape=tf.shape(samples_batch)
+      flatten_samples=tf.reshape(tf.cast(samples_batch, dtype=tf.int32), [samples_shape[0], tf.reduce_prod(samples_shape[1:])])
+      # values out of range are counted in the border bins, as done by histogram_fixed_width
+      flatten_samples=tf.clip_by_value(flatten_samples, 0, 255)
+      counts=tf.math.bincount(flatten_samples, minlength=256, maxlength=256, axis=-1, dtype=tf.int32)
+      return normalised_entropy(counts)
+
 @tf.function
 def get_sample_entropy(sample):
   """
@@ -396,6 +592,35 @@ def get_sample_entropy_test(values=[0,0,0,1,1,1]):
       entropy_val=sess.run(get_sample_entropy(data), feed_dict={data:values})
       print('Test data='+str(values)+' => Entropy value='+str(entropy_val))
 
+def _samples_entropies_loops(flatten_samples, nb_classes):
+  """
+  Loop based implementation of the samples normalized entropies, to be compiled with numba.
+
+  :param flatten_samples: A 2D int64 array (batchsize, pixels) of non negative class ids.
+  :param nb_classes: The number of histogram bins (max class id + 1).
+  :return: The vector of size (batchsize) with sample entropy values.
+  """
+  nb_samples, nb_pixels=flatten_samples.shape
+  entropies=np.zeros(nb_samples, dtype=np.float32)
+  for it in numba.prange(nb_samples):
+      counts=np.zeros(nb_classes, dtype=np.int64)
+      for px in range(nb_pixels):
+          counts[flatten_samples[it, px]]+=1
+      entropy=0.0
+      nb_present_classes=0
+      for class_id in range(nb_classes):
+          if counts[class_id]>0:
+              classes_prob=counts[class_id]/nb_pixels
+              entropy-=classes_prob*np.log(classes_prob)
+              nb_present_classes+=1
+      #single class samples have a null entropy
+      if nb_present_classes>1:
+          entropies[it]=entropy/np.log(nb_present_classes)
+  return entropies
+
+if numba is not None:
+  _samples_entropies_numba=numba.njit(parallel=True, fastmath=True, cache=True)(_samples_entropies_loops)
+
 def get_samples_entropies(samples_batch):
   """
   From a batch of 2D image labels, select a subset that ensures a minimum entropy.
@@ -403,20 +628,52 @@ def get_samples_entropies(samples_batch):
   :param samples_batch: The batch of input data.
   :return: The vector of size (batchsize) with sample entropy values.
   """
-  #print('input crops shape='+str(samples_batch.shape))
   nb_samples=samples_batch.shape[0]
-  entropies=np.zeros(nb_samples, dtype=np.float32)
-  flatten_samples=np.reshape(samples_batch, [nb_samples, -1]).astype(np.int)
-
-  for it in range(nb_samples):
-      #print('processing sample '+str(it))
-      classes_id_count=np.unique(flatten_samples[it], return_counts=True)
-      if len(classes_id_count[0])==1:
-          continue
-      #print('classes_id_count='+str(classes_id_count))
-      classes_prob=classes_id_count[1].astype(float)/float(len(flatten_samples[it]))
-      entropies[it]=-(classes_prob*np.log(classes_prob)).sum()/np.log(float(len(classes_prob)))
-  return entropies
+  if nb_samples==0:
+      return np.zeros(nb_samples, dtype=np.float32)
+  flatten_samples=np.reshape(samples_batch, [nb_samples, -1]).astype(np.int64)
+  #shift class ids to non negative values as expected by bincount
+  flatten_samples-=flatten_samples.min()
+  nb_classes=int(flatten_samples.max())+1
+  if numba is not None and nb_samples>=numba_entropies_min_batch_size:
+      #large batches : samples are processed in parallel
+      return _samples_entropies_numba(flatten_samples, nb_classes)
+  #all the samples histograms in a single bincount call, offsetting class ids of each sample
+  offsets=np.arange(nb_samples, dtype=np.int64)[:,np.newaxis]*nb_classes
+  counts=np.bincount((flatten_samples+offsets).ravel(), minlength=nb_samples*nb_classes).reshape(nb_samples, nb_classes)
+  classes_prob=counts/float(flatten_samples.shape[1])
+  nb_present_classes=np.count_nonzero(counts, axis=1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+      entropies=-np.where(counts>0, classes_prob*np.log(classes_prob), 0.0).sum(axis=1)/np.log(nb_present_classes)
+  #single class samples have a null entropy
+  entropies[nb_present_classes<=1]=0
+  return entropies.astype(np.float32)
+
+@tf.function
+def get_samples_entropies_tf(samples_batch):
+  """
+  Tensorflow version of get_samples_entropies, stays in the graph (no host copy) and can be used in a tf.data map.
+
+  :param samples_batch: The batch of input data (integer class ids).
+  :return: The vector of size (batchsize) with sample entropy values.
+  """
+  with tf.name_scope('samples_entropies'):
+      nb_samples=tf.shape(samples_batch)[0]
+      flatten_samples=tf.cast(tf.reshape(samples_batch, [nb_samples, -1]), dtype=tf.int32)
+      #shift class ids to non negative values as expected by bincount
+      flatten_samples-=tf.reduce_min(flatten_samples)
+      #one histogram per sample
+      counts=tf.math.bincount(flatten_samples, axis=-1)
+      classes_prob=tf.math.divide_no_nan(tf.cast(counts, dtype=tf.float32), tf.cast(tf.reduce_sum(counts, axis=-1, keepdims=True), dtype=tf.float32))
+      entropies=-tf.reduce_sum(tf.math.xlogy(classes_prob, classes_prob), axis=-1)
+      nb_present_classes=tf.cast(tf.math.count_nonzero(counts, axis=-1), dtype=tf.float32)
+      #single class samples have a null entropy
+      return tf.where(nb_present_classes>1, tf.math.divide_no_nan(entropies, tf.math.log(nb_present_classes)), 0.0)
+
+#Border Sobel operators, x and y filters stacked along the output channels axis : shape (3, 3, 1, 2)
+sobel_filters_xy=tf.stack([tf.constant([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], tf.int32),
+                           tf.constant([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], tf.int32)],
+                          axis=-1)[:,:,tf.newaxis,:]
 
 @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None], dtype=tf.int32)])
 def convert_semanticMap_contourMap(crops):
@@ -428,22 +685,14 @@ def convert_semanticMap_contourMap(crops):
 
 	:return: An image batch containing contours of a semantic maps.
 	"""
-  #Border Sobel operator
-  sobel_x = tf.constant([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], tf.int32)
-  sobel_x_filter = tf.reshape(sobel_x, [3, 3, 1,1])
-  sobel_y_filter = tf.transpose(sobel_x_filter, [1, 0, 2,3])
-
-
   image_resized = tf.expand_dims(crops, -1)
 
-  print('processed crops:', image_resized)
-  filtered_x = tf.nn.conv2d(image_resized, sobel_x_filter,
-                        strides=[1, 1, 1, 1], padding='VALID')
-  filtered_y = tf.nn.conv2d(image_resized, sobel_y_filter,
+  #single convolution pass computing both horizontal and vertical gradients (2 output channels)
+  filtered_xy = tf.nn.conv2d(image_resized, sobel_filters_xy,
                         strides=[1, 1, 1, 1], padding='VALID')
 
   #sum and threshold
-  contours_valid=tf.greater(tf.multiply(filtered_x,filtered_x)+tf.multiply(filtered_y,filtered_y), 1)
+  contours_valid=tf.greater(tf.reduce_sum(tf.multiply(filtered_xy,filtered_xy), axis=-1, keepdims=True), 1)
 
   #Add paddings to keep the same shape
   contours = tf.pad(contours_valid, paddings=[[0,0],[1,1],[1,1],[0,0]])
@@ -467,188 +716,120 @@ class FileListProcessor_Semantic_Segmentation:
       with tf.name_scope('raw_data_whithening'):
           #apply whitening on the raw data only
           if self.no_reference is False:
-              single_image_channels=tf.slice( sample,
-                                              begin=[0,0,0],
-                                              size=[-1,-1,self.single_image_raw_depth])
-              reference_img=tf.slice( sample,
-                                              begin=[0,0,self.single_image_raw_depth],
-                                              size=[-1,-1,self.single_image_reference_depth])
-              reference_img=tf.cast(reference_img, dtype=self.dtype)
-              raw_sample=tf.image.per_image_standardization(single_image_channels)
-              return tf.concat([tf.cast(raw_sample, dtype=self.dtype), reference_img], axis=2)
+              raw_sample, reference_img=tf.split(sample, [self.single_image_raw_depth, self.single_image_reference_depth], axis=2)
+              raw_sample=standardize_images(tf.cast(raw_sample, dtype=tf.float32))
+              return tf.concat([tf.cast(raw_sample, dtype=self.dtype), tf.cast(reference_img, dtype=self.dtype)], axis=2)
           else:
-              return tf.image.per_image_standardization(single_image_channels)
+              return standardize_images(tf.cast(sample, dtype=tf.float32))
 
     def _setup_load_raw_ref_images_from_separate_files(self):
       """
       Load one raw image and its related reference image and concatenate them into the same image
       images must be of the same size !
 
+      Standard image formats (see tf_native_image_formats) are always decoded with Tensorflow native ops,
+      the selected alternative reader (opencv, gdal or rasterio) is only called, through tf.numpy_function, for the other formats.
+
       TODO add asserts to heck matching sizes and expected depth
 
       :param raw_img_filename: The filename of the raw image to load.
       :param ref_img_filename: The filename of the reference image to load.
       :return: The concatenated image of same 2D size but of depth = raw.depth+ref.depth
       """
-      if self.use_alternative_imread is not None:
-        if self.use_alternative_imread == 'opencv':
-          @tf.function
-          def load_from_opencv(raw_ref_img_filenames):
-            #first split filenames into two strings
-            splitted_filenames = tf.strings.split(tf.expand_dims(raw_ref_img_filenames,0), sep=filenames_separator)
-            print('splitted_filenames.values[0]=',splitted_filenames.values[0])
-            raw_img_filename=splitted_filenames.values[0]
-            ref_img_filename=splitted_filenames.values[1]
-            # use Opencv image reading methods WARNING, take care of the channels order that may change !!!
-            raw_image = tf.py_function(imread_from_opencv, [raw_img_filename, self.opencv_read_flags], tf.float32)
-            reference_image = tf.py_function(imread_from_opencv, [ref_img_filename, cv2.IMREAD_GRAYSCALE], tf.float32)
-            #add a third channel (to be compatible with raw_image rank when willing to concatenate
-            raw_image=tf.cond(tf.rank(raw_image)==3, true_fn=lambda :raw_image, false_fn=lambda: tf.expand_dims(raw_image, -1))
-            reference_image=tf.expand_dims(reference_image, -1)
-            #concatenate both images in a single one
-            return tf.concat([raw_image, reference_image], axis=2, name='concat_inputs')
-
-          self.image_loading_fn=load_from_opencv
-        
-
-        elif self.use_alternative_imread == 'gdal':
-          # use gdal image reading methods WARNING, take care of the channels order that may change !!!
-
-          @tf.function
-          def load_from_gdal(raw_ref_img_filenames):
-            #first split filenames into two strings
-            splitted_filenames = tf.strings.split(tf.expand_dims(raw_ref_img_filenames,0), sep=filenames_separator)
-            print('splitted_filenames.values[0]=',splitted_filenames.values[0])
-            raw_img_filename=splitted_filenames.values[0]
-            ref_img_filename=splitted_filenames.values[1]
-            raw_image = tf.py_function(imread_from_gdal, [raw_img_filename], tf.float32)
-            reference_image = tf.py_function(imread_from_gdal,[ref_img_filename], tf.float32)
-            #add a third channel (to be compatible with raw_image rank when willing to concatenate
-            reference_image=tf.expand_dims(reference_image, -1)                      
-            #concatenate both images in a single one
-            return tf.concat([raw_image, reference_image], axis=2, name='concat_inputs')
-
-          self.image_loading_fn=load_from_gdal
-          
-        
-        elif self.use_alternative_imread == 'rasterio':
-          # use gdal image reading methods WARNING, take care of the channels order that may change !!!
-
-          @tf.function
-          def load_from_rasterio(raw_ref_img_filenames):
-            #first split filenames into two strings
-            splitted_filenames = tf.strings.split(tf.expand_dims(raw_ref_img_filenames,0), sep=filenames_separator)
-            print('splitted_filenames.values[0]=',splitted_filenames.values[0])
-            raw_img_filename=splitted_filenames.values[0]
-            ref_img_filename=splitted_filenames.values[1]
-            raw_image = tf.py_function(imread_from_rasterio, [raw_img_filename], tf.float32)
-            reference_image = tf.py_function(imread_from_rasterio, [ref_img_filename], tf.float32)
-            #add a third channel (to be compatible with raw_image rank when willing to concatenate
-            reference_image=tf.expand_dims(reference_image, -1)
-            #concatenate both images in a single one
-            return tf.concat([raw_image, reference_image], axis=2, name='concat_inputs')
-
-          self.image_loading_fn=load_from_rasterio
-
-      else:
-          # use Tensorflow image reading methods
-          @tf.function
-          def load_from_tf(raw_ref_img_filenames):
-            #first split filenames into two strings
-            splitted_filenames = tf.strings.split(tf.expand_dims(raw_ref_img_filenames,0), sep=filenames_separator)
-            #print('splitted_filenames.values[0]=',splitted_filenames.values[0])
-            raw_img_filename=splitted_filenames.values[0]
-            ref_img_filename=splitted_filenames.values[1]
-            #-> read raw data
-            single_raw_element = tf.io.read_file(raw_img_filename)
-            single_reference_element = tf.io.read_file(ref_img_filename)
-            #decode raw data using a specific decoder
-            raw_image=tf.image.decode_png(single_raw_element, channels=self.single_image_raw_depth, dtype=None, name="single_image_raw_read")
-            reference_image=tf.image.decode_png(single_reference_element, channels=self.single_image_reference_depth, dtype=None, name="single_image_reference_read")
-            #concatenate both images in a single one
-            return tf.concat([raw_image, reference_image], axis=2, name='concat_inputs')
-
-          self.image_loading_fn=load_from_tf
-
-
-      print('raw data channels='+str(self.single_image_raw_depth))
-      print('dense semantic labels channels='+str(self.single_image_reference_depth))
+      self.image_loading_fn=get_raw_ref_images_loader(self.use_alternative_imread,
+                                                      self.opencv_read_flags,
+                                                      self.single_image_raw_depth,
+                                                      self.single_image_reference_depth)
             
     def _setup_load_raw_ref_images_from_single_file(self):
       """
       Load one raw image with its related reference image encoded as the last channel.
 
+      Standard image formats (see tf_native_image_formats) are always decoded with Tensorflow native ops,
+      the selected alternative reader (opencv, gdal or rasterio) is only called, through tf.numpy_function, for the other formats.
+
       :param raw_img_filename: The filename of the raw image to load with last channel being the reference semantic data.
 
       :return: The concatenated image of same 2D siae but of depth = raw.depth+ref.depth
       """
-      if self.use_alternative_imread == 'opencv':
-        # use Opencv image reading methodcropss WARNING, take care of the channels order that may change !!!
-        @tf.function
-        def load_from_opencv(raw_img_filename):
-          return tf.py_function(imread_from_opencv, [raw_img_filename, self.opencv_read_flags], tf.float32)
-        self.image_loading_fn=load_from_opencv
-      
-      elif self.use_alternative_imread == 'gdal':
-        # use GDAL image reading methodcropss WARNING, take care of the channels order that may change !!!
-        @tf.function
-        def load_from_gdal(raw_img_filename):
-          return tf.py_function(imread_from_gdal, [raw_img_filename], tf.float32)
-        self.image_loading_fn=load_from_gdal
-      elif self.use_alternative_imread == 'rasterio':
-        # use rasterio image reading methodcropss WARNING, take care of the channels order that may change !!!
-        @tf.function
-        def load_from_rasterio(raw_img_filename):
-          return tf.py_function(imread_from_rasterio, [raw_img_filename], tf.float32)
-        self.image_loading_fn=load_from_rasterio
-      else:
+      if not(self.use_alternative_imread in ['opencv', 'gdal', 'rasterio']):
         raise ValueError('Neither OpenCV nor GDAL selected to read data and ground truth from the same image')
+      self.image_loading_fn=get_raw_ref_image_loader(self.use_alternative_imread, self.opencv_read_flags)
         
-    def _generate_crops(self, sample_filename):
+    def _generate_crops(self, *sample_filenames):
         """
         Considering an input tensor of any shape, divide it into overlapping windows and put them into a queue.
         
         Reference : inspired from http://stackoverflow.com/questions/40186583/tensorflow-slicing-a-tensor-into-overlapping-blocks
 
-        :param input_image: Image to be sampled.
+        :param sample_filenames: The filename(s) of the image to be sampled, (raw, reference) filenames pair or a single filename.
         """
-        @tf.function
-        def crops_dataset(image_filename):
+        @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)]*len(sample_filenames))
+        def crops_dataset(*image_filenames):
           with tf.name_scope('generate_crops'):
-              input_image=self.image_loading_fn(image_filename)
+              input_image=self.image_loading_fn(*image_filenames)
               with tf.name_scope('prepare_crops_bbox'):
-                  height=tf.cast(tf.shape(input_image)[0], dtype=tf.int32, name='image_height')
-                  width=tf.cast(tf.shape(input_image)[1], dtype=tf.int32, name='image_width')
-                  #tf.print('height, width',im [height, width])
+                  #int64 to avoid overflows when computing the number of patches of large images
+                  image_shape=tf.shape(input_image, out_type=tf.int64)
+                  height=tf.identity(image_shape[0], name='image_height')
+                  width=tf.identity(image_shape[1], name='image_width')
                   if self.shuffle_samples is True:
-                      self.nbPatches=tf.cast(self.image_area_coverage_factor*tf.cast(height*width, dtype=tf.float32)/tf.constant(self.patchSize*self.patchSize, dtype=tf.float32), dtype=tf.int32, name='number_of_patches')
-                      self.nbPatches=tf.minimum(self.nbPatches, tf.constant(self.max_patches_per_image, name='max_patches_per_image'), name='saturate_number_of_patches')
-                      random_vector_shape = tf.expand_dims(self.nbPatches,0)
-                      top_coord = tf.random.uniform(random_vector_shape,0, height-self.patchSize,dtype=tf.int32,name='patch_top_coord_top')
-                      left_coord = tf.random.uniform(random_vector_shape,0,width-self.patchSize, dtype=tf.int32,name='patch_left_coord')
+                      #integer only arithmetic, coverage factor is given in per ten thousand
+                      nb_patches=tf.math.floordiv(self.image_area_coverage_per10k*height*width, 10000*self.patchSize*self.patchSize, name='number_of_patches')
+                      nb_patches=tf.minimum(nb_patches, self.max_patches_per_image, name='saturate_number_of_patches')
+                      random_vector_shape = tf.expand_dims(nb_patches,0)
+                      top_coord = tf.random.uniform(random_vector_shape,0, height-self.patchSize,dtype=tf.int64,name='patch_top_coord_top')
+                      left_coord = tf.random.uniform(random_vector_shape,0,width-self.patchSize, dtype=tf.int64,name='patch_left_coord')
+                      if self.crops_presampling_rate is not None:
+                          # cheap uniform pre-selection of the crop candidates : rejected candidates are neither
+                          # extracted nor processed by the costly filters (labels entropy...)
+                          presampled=tf.random.uniform(random_vector_shape, 0, 1) < self.crops_presampling_rate
+                          top_coord=tf.boolean_mask(top_coord, presampled, name='presampled_top_coord')
+                          left_coord=tf.boolean_mask(left_coord, presampled, name='presampled_left_coord')
+                          random_vector_shape=tf.shape(top_coord)
+                      # extract all the crops in a single op : normalized boxes that match exact pixel positions
+                      # and nearest neighbor sampling ensure no interpolation (reference labels are preserved)
+                      height_norm=tf.cast(height-1, dtype=tf.float32)
+                      width_norm=tf.cast(width-1, dtype=tf.float32)
+                      top_norm=tf.cast(top_coord, dtype=tf.float32)/height_norm
+                      left_norm=tf.cast(left_coord, dtype=tf.float32)/width_norm
+                      boxes=tf.stack([top_norm,
+                                      left_norm,
+                                      top_norm+(self.patchSize-1)/height_norm,
+                                      left_norm+(self.patchSize-1)/width_norm], axis=1)
+                      all_crops=tf.image.crop_and_resize(tf.expand_dims(input_image,0),
+                                                         boxes=boxes,
+                                                         box_indices=tf.zeros(random_vector_shape, dtype=tf.int32),
+                                                         crop_size=[self.patchSize, self.patchSize],
+                                                         method='nearest',
+                                                         name='random_crops')
                   
                   else: #expecting TEST dataset use case : no padding, only processing original pixels, avoiding border effects
-                      top_coord = tf.range(0, height-self.patchSize,self.patchSize-2*self.radius_of_view,dtype=tf.int32)
-                      left_coord = tf.range(0,width-self.patchSize, self.patchSize-2*self.radius_of_view,dtype=tf.int32)
-
-                      flat_meshgrid_y, flat_meshgrid_x = tf.meshgrid(top_coord, left_coord)
-                      left_coord = tf.reshape(flat_meshgrid_x, [-1])
-                      top_coord =  tf.reshape(flat_meshgrid_y, [-1])
-                      self.nbPatches = tf.shape(left_coord)[0]
-
-                  boxes_raw=tf.stack([top_coord, left_coord], axis=1)
-                  
-                  @tf.function
-                  def get_crop(boxe):
-                    crop=tf.image.crop_to_bounding_box(input_image, boxe[0], boxe[1], self.patchSize, self.patchSize)
-                    return crop# cast will be done later...tf.cast(crop, self.dtype)
-                  crops_bb=tf.data.Dataset.from_tensor_slices(boxes_raw)
-                  crops=crops_bb.map(get_crop)#, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
-                  
-                  # return the per image dataset BUT filter out unnecessary crops BEFORE
-                  return crops.filter(self._crop_filter).prefetch(tf.data.AUTOTUNE)
-        print("++++++++++++++++++++++++++++++++", sample_filename)
-        return crops_dataset(sample_filename)
+                      # regular grid of overlapping crops extracted in a single op. Same grid as tf.range(0, size-patchSize, stride) :
+                      # the last row/column is dropped so that the crop offsets remain strictly below size-patchSize
+                      crops_stride=self.patchSize-2*self.radius_of_view
+                      patches=tf.image.extract_patches(tf.expand_dims(input_image[:-1,:-1],0),
+                                                       sizes=[1, self.patchSize, self.patchSize, 1],
+                                                       strides=[1, crops_stride, crops_stride, 1],
+                                                       rates=[1, 1, 1, 1],
+                                                       padding='VALID',
+                                                       name='grid_crops')
+                      # crops ordered column by column (left coordinate as the outer loop), as with the former meshgrid of boxes
+                      all_crops=tf.reshape(tf.transpose(patches[0], [1, 0, 2]), [-1, self.patchSize, self.patchSize, tf.shape(input_image)[2]])
+
+                  # cast will be done later...tf.cast(crop, self.dtype)
+                  # filter out unnecessary crops BEFORE returning the per image dataset, all crops are checked at once
+                  # (prefetching is managed by the parallel interleave and at the end of the pipeline)
+                  if self.nb_filters>0:
+                    all_crops=tf.boolean_mask(all_crops, self._crop_filter(all_crops), name='selected_crops')
+                  if self.manage_nan_values == 'zeros':
+                    all_crops=replace_nans_by_zeros(all_crops)
+                  # static crops shape for the next batching and transforms
+                  all_crops=tf.ensure_shape(all_crops, [None]+self.cropSize)
+                  return tf.data.Dataset.from_tensor_slices(all_crops)
+        if self.debug:
+          tf.print('Generating crops from', *sample_filenames)
+        return crops_dataset(*sample_filenames)
 
     def _setup_crop_filters(self):
       """
@@ -656,90 +837,65 @@ class FileListProcessor_Semantic_Segmentation:
       """
       print('*************************** FILTERS ***************************')
       print(self.additionnal_filters)
+      # filters are applied to all the crops of an image at once, the user defined filters
+      # that process a single crop are vectorized to return a boolean per crop
+      self.crops_filters=[get_crops_filter(crop_filter) for crop_filter in self.additionnal_filters]
       if self.balance_classes_distribution is True  and self.no_reference is False: #TODO second test is a safety test that could be removed is safety test done before
           print('-> crops filter: crops filtering taking into account ground truth entropy')
-          @tf.function #(input_signature=[tf.TensorSpec(shape=[None, None, None], dtype=self.dtype)])
-          def balance_classes_entropy(crop):
-            ref_slice=tf.slice(crop,
-                              begin=[0,0,self.single_image_raw_depth],
-                              size=[-1,-1,self.single_image_reference_depth])
-            return tf.greater(get_sample_entropy_int(tf.reshape(ref_slice,[-1])), self.classes_entropy_threshold, name='minimum_labels_entropy_selection')
+          @tf.function #(input_signature=[tf.TensorSpec(shape=[None, None, None, None], dtype=self.dtype)])
+          def balance_classes_entropy(crops):
+            ref_slices=tf.slice(crops,
+                              begin=[0,0,0,self.single_image_raw_depth],
+                              size=[-1,-1,-1,self.single_image_reference_depth])
+            # all the crops labels histograms at once
+            return tf.greater(get_sample_entropies_int_batched(ref_slices), self.classes_entropy_threshold, name='minimum_labels_entropy_selection')
           # add this filter as first in the filters list
-          self.additionnal_filters.insert(0,balance_classes_entropy)
+          self.crops_filters.insert(0,balance_classes_entropy)
 
       if self.manage_nan_values == 'avoid':
           print('-> crops filter: crops with Nan values will be avoided')
           @tf.function #(input_signature=[tf.TensorSpec(shape=None, dtype=self.dtype)])
-          def has_no_nans(crop):
-            return tf.logical_not(tf.reduce_any(tf.math.is_nan(crop)))#tf.math.logical_and(selected_crops, tf.reduce_any(tf.is_nan(crop_candidate, axis=0)))
+          def has_no_nans(crops):
+            return tf.logical_not(tf.reduce_any(tf.math.is_nan(crops), axis=[1,2,3]))
           # add this filter as first in the filters list
-          self.additionnal_filters.insert(0,has_no_nans)
+          self.crops_filters.insert(0,has_no_nans)
       #final counts
-      self.nb_filters=len(self.additionnal_filters)
+      self.nb_filters=len(self.crops_filters)
+
+      #the fused filters predicate, built once
+      @tf.function
+      def crop_filter(crops):
+        with tf.name_scope('filter_crops'):
+          # all the filters are evaluated on all the crops and combined in a single reduction,
+          # no control flow (tf.cond cascade or tf.while_loop over the filters)
+          filters_ok=tf.stack([crops_filter(crops) for crops_filter in self.crops_filters], axis=0)
+          return tf.reduce_all(filters_ok, axis=0)
+      self.crop_filter_fn=crop_filter
 
-    def _crop_filter(self, crop):
+    def _crop_filter(self, crops):
       """
-      A tf.data.Dataset filter function.
+      A crops selection function, all the filters are fused in a single predicate.
       
-      :param crops: A set of crop candidates.
+      :param crops: A set of crop candidates, a [nb_crops, height, width, channels] tensor.
         
       :return selected_crops: A vector of size equal to the number of input crops with True for accepted candidates, False if not.
       """
-      print('_crop_filter, input tensor=', crop)
-    
-      @tf.function
-      def crop_filter(crop):
-        with tf.name_scope('filter_crops'):
-          #next processing wrt config
-          
-          """
-          #run all filters as a cascade, one skip the remaining filters as long as one filter refuses the crop
-          def run_filters_cond(filters, crop):
-            #if no more filter should be applied, then the crop is accepted
-            if len(filters)==0:
-                return  tf.constant(True)
-            print('--> applying filter:',filters[0])
-            # if current filter rejects the crop, then return stop, else, aply next filter
-            return tf.cond(filters[0](crop), lambda: run_filters_cond(filters[1:], crop), lambda:tf.constant(False))
-          print('Processing crop filter list :',self.additionnal_filters)
-          selected_crop=run_filters_cond(self.additionnal_filters, crop)
-          
-          filter_ok=tf.constant(True)
-          filter_id=tf.constant(1)
-          c = lambda filter_id, filter_ok:filter_ok
-          b = lambda filter_id, filter_ok: (tf.add(filter_id, 1), tf.math.logical_and(filter_ok, self.additionnal_filters[filter_id](crop)))
-          filter_id, filter_ok = tf.while_loop(c, b, [filter_id, filter_ok])
-          return filter_ok
-
-          """
-          filter_ok=True
-          for i in range(self.nb_filters):
-            filter_ok&= self.additionnal_filters[i](crop)
-          return filter_ok
-          """
-          #selected_crop=tf.Print(selected_crop, [selected_crop], message=('Crop is selected'))
-          return selected_crop
-          """
-      return crop_filter(crop)
+      return self.crop_filter_fn(crops)
 
     def _setup_image_transforms(self):
       """
       Prepare a list of tf functions to be applied along the data pipeline.
-      """
-      #prepare a random number generator that will act on the random image transforms
-      self.rng = tf.random.Generator.from_seed(self.seed, alg='philox')
 
+      All the transforms process batches of samples, [batch_size, height, width, channels] tensors,
+      random transforms draw their parameters for each sample independently.
+      """
       self.image_label_transforms=[]
       print('*************************** Image transforms ***************************')
 
       #apply basic transforms to both image data AND associated metadata (labels and so on)
       if self.manage_nan_values == 'zeros':
+          # done once when generating the samples (before caching), see replace_nans_by_zeros
           print('-> nan replacement by zeros')
-          @tf.function
-          def replace_nans_by_zeros(sample, seed):
-            """ returns a tensor with input nan values replaced by zeros """
-            return tf.where(tf.math.is_nan(sample), tf.zeros_like(sample), sample)
-          self.image_label_transforms.append(replace_nans_by_zeros)
       if self.apply_random_flip_left_right:
           print('-> random flipping left right')
           self.image_label_transforms.append(tf.image.stateless_random_flip_left_right)
@@ -748,33 +904,46 @@ class FileListProcessor_Semantic_Segmentation:
           self.image_label_transforms.append(tf.image.stateless_random_flip_up_down)
       if self.apply_random_rot90:
           print('-> random random 90deg rotation')
+          # quarter turns change the shape of non square samples (full frames) that could then not be batched,
+          # those are only rotated by 0 or 180 deg
+          square_samples=self.cropSize[0]==self.cropSize[1]
           @tf.function
           def random_rot90(img, seed):
-            return tf.image.rot90(img, tf.random.uniform(shape=[], minval=0, maxval=4, dtype=tf.int32))
+            # one random number of quarter turns per sample, rotations are selected per sample (no per sample control flow)
+            nb_quarter_turns=tf.random.stateless_uniform([tf.shape(img)[0],1,1,1], seed=seed, minval=0, maxval=4, dtype=tf.int32)
+            rotated=tf.where(nb_quarter_turns>=2, tf.reverse(img, axis=[1,2]), img)
+            if square_samples:
+              rotated=tf.where(nb_quarter_turns%2==1, tf.transpose(tf.reverse(rotated, axis=[2]), [0,2,1,3]), rotated)
+            return rotated
           self.image_label_transforms.append(random_rot90)
 
       self.image_pixels_transforms=[]
-      if self.no_reference is False: #if using a reference channel, then apply transform only of the raw data
-          @tf.function
-          def get_image_channels(img, seed):
-            return tf.slice( img,
-                                          begin=[0,0,0],
-                                          size=[-1,-1,self.single_image_raw_depth])
-          self.image_pixels_transforms.append(get_image_channels)
-
-
+      #pixel transforms apply to the raw data only, reference channels are split out before, see _image_transform
       if self.apply_whitening:     # Subtract off the mean and divide by the variance of the pixels.
           print('-> image standardization')
           @tf.function
           def img_standardize(img, seed):
-            return tf.image.per_image_standardization(img)
+            # whole batch standardized with one reduction over each sample axes, fused with the next transforms
+            return standardize_images(img)
           self.image_pixels_transforms.append(img_standardize)
+
+      # next pixel transforms are computed in the pipeline data type if it is a floating one (typically half precision),
+      # casting only after the whitening preserves the raw data precision.
+      # Integer data types (ex: uint8) are only cast after the last pixel transform, random transforms run in float32.
+      @tf.function
+      def cast_to_dtype(img, seed):
+        return tf.cast(img, dtype=self.dtype)
+      cast_early=tf.as_dtype(self.dtype).is_floating
+      if cast_early:
+          self.image_pixels_transforms.append(cast_to_dtype)
           
       if self.apply_random_brightness is not None:
           print('-> random brightness, max_delta=', self.apply_random_brightness)
           @tf.function
           def apply_random_brightness(img, seed):
-            return tf.image.stateless_random_brightness(img, max_delta=self.apply_random_brightness, seed=seed)
+            # one random delta per sample (tf.image.stateless_random_brightness would draw a single one for the batch)
+            delta=tf.random.stateless_uniform([tf.shape(img)[0],1,1,1], seed=seed, minval=-self.apply_random_brightness, maxval=self.apply_random_brightness, dtype=img.dtype)
+            return img+delta
           self.image_pixels_transforms.append(apply_random_brightness)
 
       if self.apply_random_saturation is not None:
@@ -783,7 +952,11 @@ class FileListProcessor_Semantic_Segmentation:
           print('-> random saturation (lower, upper)=', (low, high))
           @tf.function
           def apply_random_saturation(img, seed):
-            return tf.image.stateless_random_saturation(img, lower=low, upper=high, seed=seed)
+            # one random saturation factor per sample, same processing as tf.image.adjust_saturation
+            factor=tf.random.stateless_uniform([tf.shape(img)[0],1,1], seed=seed, minval=low, maxval=high, dtype=img.dtype)
+            hue, saturation, value=tf.unstack(tf.image.rgb_to_hsv(img), axis=-1)
+            saturation=tf.clip_by_value(saturation*factor, 0.0, 1.0)
+            return tf.image.hsv_to_rgb(tf.stack([hue, saturation, value], axis=-1))
           self.image_pixels_transforms.append(apply_random_saturation)
       
       if self.apply_random_contrast is not None:
@@ -792,12 +965,22 @@ class FileListProcessor_Semantic_Segmentation:
           print('-> random contrast (lower, upper)=', (low, high))
           @tf.function
           def apply_random_contrast(img, seed):
-            return tf.image.stateless_random_contrast(img, lower=low, upper=high, seed=seed)
+            # one random contrast factor per sample, same processing as tf.image.adjust_contrast
+            factor=tf.random.stateless_uniform([tf.shape(img)[0],1,1,1], seed=seed, minval=low, maxval=high, dtype=img.dtype)
+            mean=tf.reduce_mean(img, axis=[1,2], keepdims=True)
+            return (img-mean)*factor+mean
           self.image_pixels_transforms.append(apply_random_contrast)
+
+      if not cast_early:
+          self.image_pixels_transforms.append(cast_to_dtype)
       
       if self.crops_postprocess is not None:
           print('-> userdefined post process')
-          self.post_process_fn=self.crops_postprocess
+          # user post process applies to a single sample, vectorize it over the batch
+          @tf.function
+          def post_process(crops, seed):
+            return tf.vectorized_map(lambda crop: self.crops_postprocess(crop, seed), crops, fallback_to_while_loop=True)
+          self.post_process_fn=post_process
       else:
           @tf.function
           def no_op(crop, seed):
@@ -807,51 +990,45 @@ class FileListProcessor_Semantic_Segmentation:
       #final counts:
       self.nb_global_transforms=len(self.image_label_transforms)
       self.nb_data_transforms=len(self.image_pixels_transforms)
+      #each transforms list is composed once into a single function
+      self.image_label_transform=compose_image_transforms(self.image_label_transforms, jit_compile=True)
+      #pixel transforms are a chain of element wise ops and reductions, XLA fuses them
+      self.image_pixels_transform=compose_image_transforms(self.image_pixels_transforms, jit_compile=True)
 
-    def _image_transform(self, input_image):
-      """
-      Apply a set of transformation to an input image.
-
-      :param input_image: The image to be transformed. It must be a stack of
-      the raw image (first layers) followed by the reference layer(s).
-
-      :return: The transformed raw+reference concatenated image, only geometric transforms are applied to the reference image.
-      """
-      print('_image_transform, input tensor=', input_image)
-
+      #the whole batch transform function, built once
       @tf.function
-      def image_transform(input_image):
+      def image_transform(input_image, batch_seed):
         with tf.name_scope('image_transform'):
-          seed = self.rng.make_seeds(2)[0]
+          # all the seeds of the batch derived at once, statelessly : one per transform (+ post process),
+          # each transform then draws the random parameters of all the samples from its own seed
+          seeds = tf.random.experimental.stateless_split(batch_seed, num=self.nb_global_transforms+self.nb_data_transforms+1)
 
-          print('Image_transform input: '+str(input_image))
-
-          #retreive a single crop
-          """ standard cropping scheme """
-          transformed_image=input_image
-          for i in range(self.nb_global_transforms):
-            #print('-> Datapipeline applyies global image transform:', transform)
-            transformed_image=self.image_label_transforms[i](transformed_image, seed)
+          transformed_image=self.image_label_transform(input_image, seeds[:self.nb_global_transforms])
           
           if self.no_reference is False: #if using a reference channel, then apply transform only of the raw data
-            reference_img=tf.slice( transformed_image,
-                                      begin=[0,0,self.single_image_raw_depth],
-                                      size=[-1,-1,self.single_image_reference_depth])
+            transformed_image, reference_img=tf.split(transformed_image, [self.single_image_raw_depth, self.single_image_reference_depth], axis=3)
             reference_img=tf.cast(reference_img, dtype=self.dtype)
 
-          for i in range(self.nb_data_transforms):
-            #print('-> Datapipeline applyies image data transform:', transform)
-            transformed_image=self.image_pixels_transforms[i](transformed_image, seed)
-
+          transformed_image=self.image_pixels_transform(transformed_image, seeds[self.nb_global_transforms:-1])
           
           if self.no_reference is False:#get back to the input+reference images concat
-            transformed_image= tf.concat([tf.cast(transformed_image, dtype=self.dtype), reference_img], axis=2)
+            transformed_image= tf.concat([transformed_image, reference_img], axis=3)
           
-          transformed_image= self.post_process_fn(transformed_image, seed)
-          print('transformed_image', transformed_image)
+          transformed_image= self.post_process_fn(transformed_image, seeds[-1])
           return transformed_image
+      self.image_transform_fn=image_transform
 
-      return image_transform(input_image)
+    def _image_transform(self, input_image, batch_seed):
+      """
+      Apply a set of transformation to a batch of input images.
+
+      :param input_image: The batch of images to be transformed. Each must be a stack of
+      the raw image (first layers) followed by the reference layer(s).
+      :param batch_seed: The [2] random seed of this batch, all the transforms random values are derived from it.
+
+      :return: The transformed raw+reference concatenated images, only geometric transforms are applied to the reference images.
+      """
+      return self.image_transform_fn(input_image, batch_seed)
 
     def _create_dataset_filenames(self):
       """
@@ -860,15 +1037,21 @@ class FileListProcessor_Semantic_Segmentation:
       :return: Create the filenames dataset.
       """
       if self.image_pairs_raw_ref_input:
-          datasetFiles=[''+string1+filenames_separator+string2  for string1,string2 in zip(self.filelist_raw_data, self.filelist_reference_data)]
+          #(raw, reference) filenames pairs, the loading functions then receive two filenames
+          datasetFiles=(list(self.filelist_raw_data), list(self.filelist_reference_data))
+          nb_files=len(datasetFiles[0])
       else: #raw and ref data in the same image of only raw data use cases
           datasetFiles=self.filelist_raw_data
+          nb_files=len(datasetFiles)
       #print(datasetFiles)
 
       #apply general setup for dataset reader : read all the input list one time, shuffle if required to, read one by one
-      self.dataset=tf.data.Dataset.from_tensor_slices(datasetFiles).repeat(self.nbEpoch)
+      self.dataset=tf.data.Dataset.from_tensor_slices(datasetFiles)
+      # shuffle the finite files list then repeat : a new order at each epoch, without mixing epochs
       if self.shuffle_samples:
-            self.dataset=self.dataset.shuffle(len(datasetFiles))
+            self.dataset=self.dataset.shuffle(nb_files, reshuffle_each_iteration=True)
+      if not(self.cache_samples): #if caching, repeat is done after the cache, see _create_data_pipeline
+            self.dataset=self.dataset.repeat(self.nbEpoch)
 
     def _setup_load_raw_images_from_filenames(self):
       """
@@ -883,6 +1066,37 @@ class FileListProcessor_Semantic_Segmentation:
       else: #raw and ref data in the same image of only raw data use cases
         self._setup_load_raw_ref_images_from_single_file()
 
+    def _skip_unreadable_samples(self):
+      """
+      Drop the samples which loading failed (unreadable or corrupted files) instead of stopping the whole pipeline.
+
+      In debug mode, errors are kept raised to ease their investigation.
+      """
+      if self.debug is False:
+        self.dataset=self.dataset.ignore_errors()
+
+    def _get_dataset_options(self):
+      """
+      Input pipeline global options : a private thread pool sized on the available cores for the python readers
+      and maps, samples order is not enforced when shuffling anyway. Static graph optimizations that are
+      not enabled by default (maps and filters fusions, maps parallelization) are also activated.
+
+      :return: The tf.data.Options to apply to the dataset.
+      """
+      options=tf.data.Options()
+      options.threading.private_threadpool_size=os.cpu_count()
+      options.deterministic=not(self.shuffle_samples)
+      options.autotune.enabled=True
+      optimizations=options.experimental_optimization
+      optimizations.apply_default_optimizations=True
+      optimizations.map_fusion=True
+      optimizations.map_and_batch_fusion=True
+      optimizations.map_and_filter_fusion=True
+      optimizations.filter_fusion=True
+      optimizations.map_parallelization=True
+      optimizations.noop_elimination=True
+      return options
+
     def _create_data_pipeline(self):
       """ 
       Input pipeline is defined on the CPU parameters.
@@ -897,18 +1111,50 @@ class FileListProcessor_Semantic_Segmentation:
 
           #2. transform the dataset samples convert raw images into crops
           if self.full_frame_mode is True:
-            self.dataset=self.dataset.map(map_func=self._load_raw_images_from_filenames, num_parallel_calls=self.num_reader_threads).prefetch(1)
+            # all the frames must share the shape of the first image to be batched (static shape), other frames are skipped as unreadable samples
+            self.dataset=self.dataset.map(map_func=lambda *filenames: tf.ensure_shape(self.image_loading_fn(*filenames), self.fullframe_ref_shape),
+                                          num_parallel_calls=tf.data.AUTOTUNE,
+                                          deterministic=not(self.shuffle_samples))
+            self._skip_unreadable_samples()
+            if self.manage_nan_values == 'zeros':
+              self.dataset=self.dataset.map(replace_nans_by_zeros, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
+            self.dataset=self.dataset.prefetch(tf.data.AUTOTUNE)
             with tf.name_scope('full_raw_frame_prefetching'):
               if self.apply_whitening:     # Subtract off the mean and divide by the variance of the pixels.
                   self.dataset=self.dataset.map(self._whiten_sample)
           else:
-              self.dataset=self.dataset.interleave(cycle_length=self.num_reader_threads, block_length=1, map_func=self._generate_crops, num_parallel_calls=self.num_reader_threads, deterministic=not(self.shuffle_samples))
+              self.dataset=self.dataset.interleave(cycle_length=self.num_reader_threads, block_length=1, map_func=self._generate_crops, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
+              self._skip_unreadable_samples()
+
+          if self.cache_samples:
+              # keep the loaded samples (filtered crops or full frames) in memory or on disk, then repeat from the cache
+              # (only the random image transforms that follow are applied at each epoch)
+              self.dataset=self.dataset.cache(filename=self.cache_file if self.cache_file is not None else '')
+              if self.shuffle_samples:
+                  # the filenames shuffle is cached, cached samples are then reshuffled at each epoch
+                  self.dataset=self.dataset.shuffle(self.batch_size*100, reshuffle_each_iteration=True)
+              self.dataset=self.dataset.repeat(self.nbEpoch)
 
-          self.dataset=self.dataset.map(self._image_transform, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
-          #finalise the dataset pipeline : filterout
           #finalize dataset (set nb epoch and batch size and prefetch)
-          self.dataset=self.dataset.batch(self.batch_size, drop_remainder=True)#, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
+          #batch first so that the image transforms process a whole batch at once
+          self.dataset=self.dataset.batch(self.batch_size, drop_remainder=True, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
+          #each batch comes with its own random seed so that the transforms map remains stateless (no shared random generator)
+          batches_seeds=tf.data.Dataset.random(seed=self.seed).batch(2)
+          self.dataset=tf.data.Dataset.zip((self.dataset, batches_seeds))
+          self.dataset=self.dataset.map(self._image_transform, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(self.shuffle_samples))
           self.dataset=self.dataset.prefetch(tf.data.AUTOTUNE)#int(self.batch_size*20))
+          self.dataset=self.dataset.with_options(self._get_dataset_options())
+          if self.tf_data_service_address is not None:
+              # the pipeline is processed by the tf.data service workers, each one runs its own epochs of the whole pipeline
+              self.dataset=self.dataset.apply(tf.data.experimental.service.distribute(processing_mode='parallel_epochs',
+                                                                                     service=self.tf_data_service_address,
+                                                                                     compression='AUTO'))
+          if self.prefetch_device is not None:
+              # must be the last transformation, batches are copied to the device while the current step runs
+              if 'GPU' in self.prefetch_device.upper() and len(tf.config.list_physical_devices('GPU'))==0:
+                  print('WARNING, no GPU available, batches are not prefetched to', self.prefetch_device)
+              else:
+                  self.dataset=self.dataset.apply(tf.data.experimental.prefetch_to_device(self.prefetch_device))
           print('Input data pipeline graph is now defined')
 
     """
@@ -938,7 +1184,7 @@ class FileListProcessor_Semantic_Segmentation:
     image_area_coverage_factor: the number of patches per images is automatically computed to get nearly the same number
       of pixels as the input image (surface coverage), this factor is applied
       to this number of patches. However the maximum limit of patches is forced by max_patches_per_image
-    num_reader_threads: the number of parallel image readers used to generate input data
+    num_reader_threads: the number of images read and cropped in parallel to generate input data, tf.data.AUTOTUNE (default) adapts it to the available cores
     apply_random_flip_left_right: set True if input should be randomly mirrored left-right,
     apply_random_flip_up_down: set True if input should be randomly mirrored up-down
     apply_random_rot90: set True to apply random 90 deg rotations
@@ -957,6 +1203,17 @@ class FileListProcessor_Semantic_Segmentation:
     manage_nan_values: set 'zeros' to replace nan values by zeros, 'avoid' to avoid sample crops with nan values, None else and Exception will be raised to highlight potential dataset problems
     additionnal_filters: must be a list of functions (empty by default) that take 1 parameter, a tensor that represents an image crop with eventual ground truth as additionnal layers and that return True if crop is of interest, else False
     crops_postprocess: a function (or None) that postprocesses the crops (can for example separate raw data and reference while cropping the latter or something else)
+    cache_in_ram: set True to cache the samples (filtered crops or full frames) in memory (dataset must fit in RAM), images are then read and cropped only once,
+      random crops are then drawn once and replayed at each epoch, image transforms remain applied on the fly.
+      If shuffle_samples is True, the cached samples are reshuffled at each epoch (shuffle buffer of batch_size*100 samples)
+    cache_file: None or a file path prefix to cache the samples on disk (same behavior as cache_in_ram, including the per epoch reshuffling, but for datasets larger than RAM),
+      the cache files are reused by later runs
+    crops_presampling_rate: None or a value in ]0,1], if shuffle_samples is True, the random crop candidates are uniformly pre-selected with this probability
+      before being extracted and filtered, reduces the filters cost (e.g. labels entropy) when most candidates are rejected
+    tf_data_service_address: None or the address of a tf.data service dispatcher (e.g. 'grpc://dispatcher:5000') to distribute the pipeline processing on its workers,
+      only Tensorflow image readers are supported (use_alternative_imread=False), python image readers can not be run by the workers
+    prefetch_device: None or a device name (e.g. '/GPU:0') to prefetch the batches in this device memory, ignored if no GPU is available
+      WARNING, not compatible with distribution strategies that distribute the dataset themselves (e.g. MirroredStrategy with model.fit)
     dtype: the pixel data type to be used (default is tf.float32, more memory efficient format should be tf.float16)
     """
 
@@ -967,7 +1224,7 @@ class FileListProcessor_Semantic_Segmentation:
                     patch_ratio_vs_input=0.2,
                     max_patches_per_image=10,
                     image_area_coverage_factor=2.0,
-                    num_reader_threads=4,
+                    num_reader_threads=tf.data.AUTOTUNE,
                     apply_random_flip_left_right=True,
                     apply_random_flip_up_down=False,
                     apply_random_rot90=False,
@@ -986,6 +1243,11 @@ class FileListProcessor_Semantic_Segmentation:
                     crops_postprocess=None,
                     dtype=tf.float16,
                     seed=42,
+                    cache_in_ram=False,
+                    cache_file=None,
+                    crops_presampling_rate=None,
+                    tf_data_service_address=None,
+                    prefetch_device=None,
                     debug=False):
       self.filelist_raw_data=filelist_raw_data
       self.filelist_reference_data=filelist_reference_data
@@ -994,6 +1256,7 @@ class FileListProcessor_Semantic_Segmentation:
       self.patch_ratio_vs_input=patch_ratio_vs_input
       self.max_patches_per_image=max_patches_per_image
       self.image_area_coverage_factor=float(image_area_coverage_factor)
+      self.image_area_coverage_per10k=int(round(self.image_area_coverage_factor*10000))
       self.num_reader_threads=num_reader_threads
       self.apply_random_flip_left_right=apply_random_flip_left_right
       self.apply_random_flip_up_down=apply_random_flip_up_down
@@ -1011,7 +1274,14 @@ class FileListProcessor_Semantic_Segmentation:
       self.manage_nan_values=manage_nan_values
       self.crops_postprocess=crops_postprocess
       self.dtype=dtype
-      self.seed=seed
+      # the seed may be given as a python int or a size 1 array, tf.data.Dataset.random expects a scalar
+      self.seed=None if seed is None else int(np.asarray(seed).ravel()[0])
+      self.cache_in_ram=cache_in_ram
+      self.cache_file=cache_file
+      self.cache_samples=self.cache_in_ram or self.cache_file is not None
+      self.crops_presampling_rate=crops_presampling_rate
+      self.tf_data_service_address=tf_data_service_address
+      self.prefetch_device=prefetch_device
       self.debug = debug
       if additionnal_filters is None:
         self.additionnal_filters=[]
@@ -1020,6 +1290,14 @@ class FileListProcessor_Semantic_Segmentation:
 
       if self.image_area_coverage_factor<=0:
         raise ValueError('Error when constructing DataProvider: image_area_coverage_factor must be above 0')
+      if self.image_area_coverage_per10k==0:
+        raise ValueError('Error when constructing DataProvider: image_area_coverage_factor must be at least 0.00005, no crop would be drawn')
+
+      if self.crops_presampling_rate is not None and not(0<self.crops_presampling_rate<=1):
+        raise ValueError('Error when constructing DataProvider: crops_presampling_rate must be None or in range ]0,1]')
+
+      if self.tf_data_service_address is not None and self.use_alternative_imread in ['opencv', 'gdal', 'rasterio']:
+        raise ValueError('Error when constructing DataProvider: tf.data service workers can not run the python image readers, set use_alternative_imread=False')
 
       if not(isinstance(self.additionnal_filters, list)):
         raise ValueError('Error when constructing DataProvider: additionnal_filters must be a list of functions that take 1 parameter, a tensor that represents a crop with eventual ground truth as additionnal layers and return True if crop is of interest, else False')
@@ -1030,8 +1308,10 @@ class FileListProcessor_Semantic_Segmentation:
         raw0=imread_from_gdal(filelist_raw_data[0], True)
       elif self.use_alternative_imread == 'rasterio':
         raw0=imread_from_rasterio(filelist_raw_data[0], True)
-      else:
+      elif self.use_alternative_imread == 'opencv':
         raw0=imread_from_opencv(filelist_raw_data[0],opencv_read_flags)
+      else: #Tensorflow readers only, as done by the pipeline
+        raw0=imread_from_tf(filelist_raw_data[0]).numpy()
       print('Read first raw image {filepath} of shape {shape}'.format(filepath=filelist_raw_data[0], shape=raw0.shape))
       self.single_image_raw_width = raw0.shape[0]
       self.single_image_raw_height = raw0.shape[1]
@@ -1049,7 +1329,10 @@ class FileListProcessor_Semantic_Segmentation:
           print('*** Dataprovider is sampling raw data and reference data lists')
           self.image_pairs_raw_ref_input=True
           #-> case of raw images plus separate reference images
-          ref0=cv2.imread(filelist_reference_data[0],self.opencv_read_flags)
+          if self.use_alternative_imread in ['opencv', 'gdal', 'rasterio']:
+            ref0=cv2.imread(filelist_reference_data[0],self.opencv_read_flags)
+          else:
+            ref0=imread_from_tf(filelist_reference_data[0]).numpy()
           print('read first reference image {filepath} of shape {shape}'.format(filepath=filelist_reference_data[0], shape=ref0.shape))
           if (raw0.shape[0] != ref0.shape[0]) or (raw0.shape[1] != ref0.shape[1]):
               raise ValueError('FileListProcessor_input::__init__ Error, first input files do not have the same pixel size')
@@ -1060,16 +1343,15 @@ class FileListProcessor_Semantic_Segmentation:
           else:
               raise ValueError('input image shape not supported:'+str(raw0.shape))
           self.single_image_reference_depth=1
-          self.fullframe_ref_shape=list(raw0.shape)
-          self.fullframe_ref_shape[-1]=self.single_image_raw_depth+self.single_image_reference_depth
-
           if len(ref0.shape)>2:
               self.single_image_reference_depth=ref0.shape[2]
+          self.fullframe_ref_shape=[raw0.shape[0], raw0.shape[1], self.single_image_raw_depth+self.single_image_reference_depth]
       else:
           print('*** Dataprovider is sampling raw data but not providing any reference data')
           self.no_reference=True
           self.single_image_raw_depth=raw0.shape[2]
           self.single_image_reference_depth=0
+          self.fullframe_ref_shape=list(raw0.shape)
       self.img_ratio=float(raw0.shape[0])/float(raw0.shape[1])
 
       print('raw data channels='+str(self.single_image_raw_depth))
@@ -1183,7 +1465,11 @@ def FileListProcessor_csv_time_series(files,
                                       per_sample_preprocess_fn=None,
                                       selected_cols=None,
                                       shuffle=False,
-                                      post_proc_filter=None):
+                                      post_proc_filter=None,
+                                      cache_in_ram=False,
+                                      cache_dir=None,
+                                      read_whole_files=True,
+                                      read_whole_files_max_size=32<<20):
   """
   A standard data pipeline dedicated to time series stored in collections of csv files.
 
@@ -1199,39 +1485,136 @@ def FileListProcessor_csv_time_series(files,
   :param per_sample_preprocess_fn: If some specific sample level processing should be performed, privide here the function that does this (def mypost_proc(Tensor sample) returns Tensor).
   :param selected_cols: The python list of indexes of data columns of interest.
   :param shuffle=False: Set True to activate samples shuffling (best for training).
-  :param post_proc_filter: If some specific sample filtering should be performed, specify here a dedicated function (def mypost_proc(Tensor sample) returns Binary Tensor).
+  :param post_proc_filter: If some specific sample filtering should be performed, specify here a dedicated function that processes a batch of samples (def mypost_proc(Tensor samples_batch) returns a Binary Tensor of shape [batch_size]).
+  :param cache_in_ram: Set True to cache the decoded (and filtered) samples in memory (dataset must fit in RAM), csv files are then parsed only once.
+  :param cache_dir: None or a folder where to cache the decoded samples on disk (same behavior as cache_in_ram but for datasets larger than RAM), the cache files are reused by later runs.
+  :param read_whole_files: Set True to read and decode each csv file at once then frame its rows as samples (each line is decoded only once), set False to read files by lines windows when a single file does not fit in RAM.
+    When shuffling, the files order is shuffled at each epoch and the samples shuffle buffer then holds batch_size*4 decoded samples if True,
+    batch_size*100 raw lines windows strings (lighter) if False.
+  :param read_whole_files_max_size: With read_whole_files=True and overlapping windows (windowing_shift < temporal_series_length), all the windows of a file
+    are framed at once, taking about temporal_series_length/windowing_shift times the decoded file size in memory. If a file is larger than this size (in bytes),
+    files are read by lines windows instead. Non overlapping windows are always read from whole files.
   """
-
-  @tf.function
-  def decode_csv(line):
-    features = tf.io.decode_csv(line, record_defaults=record_defaults_values, field_delim=csv_field_delim, na_value=na_value_string, select_cols=selected_cols)
-    labels = tf.stack(features[:labels_cols_nb], axis=0)
-    raw_data= tf.stack(features[labels_cols_nb:], axis=0)
+  # default values and selected columns are converted once for all the decoding functions
+  record_defaults = tuple(tf.constant(value) for value in record_defaults_values)
+  if selected_cols is not None:
+    selected_cols = tuple(selected_cols)
+  if read_whole_files and windowing_shift < temporal_series_length:
+    # overlapping windows framed at once multiply the file memory footprint, large files are streamed instead
+    largest_file_size = max([tf.io.gfile.stat(filename).length for filename in tf.io.gfile.glob(files)], default=0)
+    if largest_file_size > read_whole_files_max_size:
+      print('FileListProcessor_csv_time_series: largest file size {size} bytes > read_whole_files_max_size with overlapping windows, reading files by lines windows'.format(size=largest_file_size))
+      read_whole_files = False
+
+  def columns_to_samples(columns, lines_shape):
+    """ gather decoded [batch*T] columns as [batch, C, T] samples, specialized on the (static) number of columns
+    """
+    if len(columns) == 0:
+      return tf.zeros([lines_shape[0], 0, lines_shape[1]])
+    if len(columns) == 1:
+      return tf.reshape(columns[0], [lines_shape[0], 1, lines_shape[1]])
+    # stack to [batch*T, C], recover [batch, T, C] then get back to the per sample [C, T] layout
+    return tf.transpose(tf.reshape(tf.stack(columns, axis=-1), [lines_shape[0], lines_shape[1], len(columns)]), [0, 2, 1])
+
+  @tf.function(input_signature=[tf.TensorSpec([None, temporal_series_length], tf.string)])
+  def decode_csv_batched(lines):
+    # lines is a [batch, temporal_series_length] string tensor, decode all its lines with a single decode_csv call
+    lines_shape = tf.shape(lines)
+    features = tf.io.decode_csv(tf.reshape(lines, [-1]), record_defaults=record_defaults, field_delim=csv_field_delim, na_value=na_value_string, select_cols=selected_cols)
+    labels = columns_to_samples(features[:labels_cols_nb], lines_shape)
+    raw_data = columns_to_samples(features[labels_cols_nb:], lines_shape)
+    return preprocess_batch(raw_data, labels)
+
+  def preprocess_batch(raw_data, labels):
     if per_sample_preprocess_fn is not None:
         #tf.print('CSV DECODE', raw_data, labels)
-        return per_sample_preprocess_fn(raw_data, labels)
+        return tf.vectorized_map(lambda sample: per_sample_preprocess_fn(*sample), (raw_data, labels), fallback_to_while_loop=True)
     return raw_data, labels
+
+  def columns_to_framed_samples(columns, rows_nb):
+    """ frame decoded [rows] columns as [windows, C, T] samples
+    """
+    rows = tf.stack(columns, axis=-1) if len(columns) > 0 else tf.zeros([rows_nb, 0])
+    # [windows, T, C] strided windows, then get back to the per sample [C, T] layout
+    return tf.transpose(tf.signal.frame(rows, frame_length=temporal_series_length, frame_step=windowing_shift, axis=0), [0, 2, 1])
+
+  def read_file_samples(file):
+    """ read and decode a whole file at once then frame its rows in a sliding window fashion.
+    All the windows are created at once : with overlapping windows, memory grows by about temporal_series_length/windowing_shift
+    compared to the decoded file, so this path is only used for non overlapping windows or files below read_whole_files_max_size,
+    read_lines_windows streams the windows of larger files.
+    """
+    lines = tf.strings.strip(tf.strings.split(tf.io.read_file(file), '\n')[1:])
+    lines = tf.boolean_mask(lines, tf.strings.length(lines) > 0)
+    features = tf.io.decode_csv(lines, record_defaults=record_defaults, field_delim=csv_field_delim, na_value=na_value_string, select_cols=selected_cols)
+    rows_nb = tf.shape(lines)[0]
+    labels = columns_to_framed_samples(features[:labels_cols_nb], rows_nb)
+    raw_data = columns_to_framed_samples(features[labels_cols_nb:], rows_nb)
+    return tf.data.Dataset.from_tensor_slices((raw_data, labels))
+
+  cache_samples = cache_in_ram or cache_dir is not None
+  if cache_dir is not None:
+    os.makedirs(cache_dir, exist_ok=True)
   #create a dataset from the list of files to process
-  files_dataset=tf.data.Dataset.list_files(files).repeat(epochs)
+  files_dataset=tf.data.Dataset.list_files(files, shuffle=shuffle)
+  if not(cache_samples): #if caching, repeat is done after the cache
+    files_dataset=files_dataset.repeat(epochs)
   #a thread processes each file and each one is read by line blocks of length 'temporal_series_length'
   
-  #read file lines in a sliding window fashion
-  datasets = files_dataset.flat_map(lambda file: (tf.data.TextLineDataset(file).skip(1).window(size=temporal_series_length, shift=windowing_shift, drop_remainder=True)))
-
-  #each window being a dataset, make them a single batch to recover a timeseries sample
-  dataset = datasets.flat_map(lambda x:x.batch(temporal_series_length, drop_remainder=True))
+  def read_lines_windows(file):
+    """ read file lines in a sliding window fashion, each window being batched to recover a timeseries sample
+    """
+    lines = tf.data.TextLineDataset(file, buffer_size=8<<20).skip(1)
+    if windowing_shift == temporal_series_length:
+      # non overlapping windows, a simple batch avoids the nested windows datasets
+      return lines.batch(temporal_series_length, drop_remainder=True)
+    return lines.window(size=temporal_series_length, shift=windowing_shift, drop_remainder=True).flat_map(lambda x:x.batch(temporal_series_length, drop_remainder=True))
+  # files are read and windowed concurrently, either as decoded samples or raw lines windows
+  dataset = files_dataset.interleave(read_file_samples if read_whole_files else read_lines_windows, cycle_length=tf.data.AUTOTUNE, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(shuffle))
   
-  # decode csv lines
-  dataset = dataset.map(decode_csv, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(shuffle))
+  # shuffle the samples, on top of the files order shuffled by list_files at each epoch:
+  # a small buffer of decoded [C, T] samples when reading whole files,
+  # a larger buffer of raw lines windows (lighter strings) before decoding when reading by lines windows
+  if shuffle and not(cache_samples):
+    dataset=dataset.shuffle(batch_size*4 if read_whole_files else batch_size*100, reshuffle_each_iteration=True)
+
+  # batch the samples, lines windows are decoded by batches
+  # (the last partial batch is kept if filtering or caching since samples are rebatched afterwards)
+  rebatch_samples = cache_samples or post_proc_filter is not None
+  dataset = dataset.batch(batch_size, drop_remainder=not(rebatch_samples))
+  if read_whole_files:
+    if per_sample_preprocess_fn is not None:
+      dataset = dataset.map(preprocess_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(shuffle))
+  else:
+    dataset = dataset.map(decode_csv_batched, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(shuffle))
 
-  # apply filter if provided
+  # apply filter if provided on the whole batch
   if post_proc_filter is not None:
-    dataset=dataset.filter(post_proc_filter)  
-
-  if shuffle:
-    dataset=dataset.shuffle(batch_size*100)
-    
-  return dataset.batch(batch_size, drop_remainder=True).prefetch(buffer_size=tf.data.AUTOTUNE)
+    def filter_batch(*samples):
+      mask = post_proc_filter(*samples)
+      return tf.nest.map_structure(lambda x: tf.boolean_mask(x, mask), samples)
+    dataset=dataset.map(filter_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not(shuffle))
+
+  if rebatch_samples:
+    dataset=dataset.unbatch()
+    if cache_samples:
+      # keep the decoded samples in memory or on disk, then repeat and shuffle from the cache
+      dataset=dataset.cache(filename=os.path.join(cache_dir, 'csv_ts_cache') if cache_dir is not None else '').repeat(epochs)
+      if shuffle:
+        dataset=dataset.shuffle(batch_size*100, reshuffle_each_iteration=True)
+    dataset=dataset.batch(batch_size, drop_remainder=True)
+
+  # private thread pool sized on the available cores, autotuned buffers within a 2GB RAM budget
+  # and the static graph optimizations that are not activated by default
+  options=tf.data.Options()
+  options.threading.private_threadpool_size=os.cpu_count()
+  options.autotune.enabled=True
+  options.autotune.ram_budget=2<<30
+  options.experimental_optimization.map_fusion=True
+  options.experimental_optimization.map_and_batch_fusion=True
+  options.experimental_optimization.map_parallelization=True
+  options.experimental_optimization.parallel_batch=True
+  return dataset.prefetch(buffer_size=tf.data.AUTOTUNE).with_options(options)
 
 def FileListProcessor_image_classification(sourceFolder, file_extension,
                                            use_alternative_imread=False,
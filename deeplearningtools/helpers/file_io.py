@@ -9,6 +9,7 @@
 # =========================================
 
 import os
+import pathlib
 import glob
 from subprocess import check_output
 
@@ -31,18 +32,15 @@ def extractFilenames(root_dir, file_extension="*.jpg", raiseOnEmpty=True):
 
     :raises ValueError: If no files are found and `raiseOnEmpty` is set to True.
     """
-    files  = []
     msg='extractFilenames: from working directory {wd}, looking for files {path} with extension {ext}'.format(wd=os.getcwd(),
                                                                                                                 path=root_dir,
                                                                                                                 ext=file_extension)
     #print(msg)
-    for root, dirnames, filenames in os.walk(root_dir):
-        file_proto=os.path.join(root, file_extension)
-        print('-> Parsing folder : '+file_proto)
-        newfiles = glob.glob(file_proto)
-        if len(newfiles)>0:
-            print('----> Found files:'+str(len(newfiles)))
-        files.extend(newfiles)
+    #single recursive directory walk, each folder is listed only once
+    #hidden files and files under hidden folders (relative to root_dir) are skipped
+    root_path = pathlib.Path(root_dir)
+    files = [str(path) for path in root_path.rglob(file_extension)
+             if path.is_file() and not any(part.startswith('.') for part in path.relative_to(root_path).parts)]
 
     if len(files)==0 and raiseOnEmpty is True:
         raise ValueError('No files found at '+msg)
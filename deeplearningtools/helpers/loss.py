@@ -10,10 +10,35 @@
 # for DeepLearningTools.
 # =========================================
 
+import contextlib
 import tensorflow as tf
 import numpy as np
 import tensorflow.keras.backend as K
 
+def _summaries_recording(every):
+  """
+  Get a context in which the summaries are recorded only once every 'every' steps of the default summary step.
+
+  :param every: The recording period, in steps. All steps are recorded if no default summary step is set.
+
+  :return: The recording context manager.
+  """
+  step=tf.summary.experimental.get_step()
+  if step is None:
+    return contextlib.nullcontext()
+  return tf.summary.record_if(lambda: tf.equal(tf.math.floormod(step, every), 0))
+
+def _maybe_scalar(name, data, every=100):
+  """
+  Write a scalar summary once every 'every' steps only, the losses being computed at each step.
+
+  :param name: The summary name.
+  :param data: The scalar to write.
+  :param every: The recording period, in steps.
+  """
+  with _summaries_recording(every):
+    tf.summary.scalar(name, data)
+
 def class_weights(samples_per_class, beta=None):
   """
   Compute class weights used to balance per-class loss during optimization.
@@ -566,21 +591,54 @@ def multi_loss(lossesList):
 
   :return: The combined loss as a single scalar value.
   """
+  #create a dedicated output log variance variable to regress per task (variable names kept for checkpoints restore)
   output_logvars=[]
-  for id, loss in enumerate(lossesList):
-      #create a dedicated output log variance variable to regress
+  for loss in lossesList:
       logvar_name='task_uncertainty_'+str(loss['name'])
       log_var = tf.Variable(tf.constant(1.0, tf.float32), name=logvar_name)
       output_logvars.append(log_var)
-      tf.summary.scalar(logvar_name, log_var)
-      precision = tf.math.exp(-log_var)
-      single_loss = precision * loss['loss_value'] + log_var
-      print('single_loss='+str(single_loss))
-      if id==0:
-        loss_sum=single_loss
-      else:
-        loss_sum+=single_loss
-  return tf.math.reduce_mean(loss_sum)
+      _maybe_scalar(logvar_name, log_var)
+  log_vars = tf.stack(output_logvars)
+  #each task loss is reduced to a scalar (per sample losses are averaged as in reduce_mean(sum_i(prec_i*loss_i+logvar_i)))
+  loss_values = tf.stack([tf.math.reduce_mean(loss['loss_value']) for loss in lossesList])
+  precisions = tf.math.exp(-log_vars)
+  return tf.math.reduce_sum(precisions * loss_values + log_vars)
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _flat_absolute_error(inputs, reconstruction):
+  """
+  XLA compiled mean absolute error between the per sample flattened inputs and reconstruction.
+  """
+  inputs_flat = tf.reshape(inputs, [tf.shape(inputs)[0], -1])
+  reconstruction_flat = tf.reshape(reconstruction, [tf.shape(reconstruction)[0], -1])
+  return tf.reduce_mean(tf.abs(inputs_flat-reconstruction_flat))
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _squared_error(inputs, reconstruction):
+  """
+  XLA compiled mean squared error between inputs and reconstruction.
+  """
+  return tf.reduce_mean(tf.math.squared_difference(inputs, reconstruction))
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _flat_xcross(inputs, reconstruction):
+  """
+  XLA compiled mean binary cross entropy between the per sample flattened inputs and reconstruction logits.
+  """
+  inputs_flat = tf.reshape(inputs, [tf.shape(inputs)[0], -1])
+  reconstruction_flat = tf.reshape(reconstruction, [tf.shape(reconstruction)[0], -1])
+  return tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=inputs_flat, logits=reconstruction_flat))
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _flat_weighted_xcross(inputs, reconstruction, pos_weight, scale):
+  """
+  XLA compiled mean weighted binary cross entropy between the per sample flattened inputs and reconstruction logits, scaled by 'scale'.
+  """
+  inputs_flat = tf.reshape(inputs, [tf.shape(inputs)[0], -1])
+  reconstruction_flat = tf.reshape(reconstruction, [tf.shape(reconstruction)[0], -1])
+  return scale*tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(labels=inputs_flat,
+                                                                       logits=reconstruction_flat,
+                                                                       pos_weight=pos_weight))
 
 def reconstruction_loss_L1(inputs, reconstruction):
   """
@@ -594,12 +652,9 @@ def reconstruction_loss_L1(inputs, reconstruction):
   :return: The computed L1 loss.
   """
   with tf.name_scope('reconstruction_loss_l1'):
-    inputs_flat = tf.layers.flatten(inputs)
-    reconstruction_flat = tf.layers.flatten(reconstruction)
     # Reconstruction loss
-    l1_loss=tf.reduce_mean(tf.abs(inputs_flat-reconstruction_flat))
-    tf.summary.scalar('L1loss', l1_loss)
-    #l1_loss=tf.Print(l1_loss, [l1_loss], message='l1_loss')
+    l1_loss=_flat_absolute_error(inputs, reconstruction)
+    _maybe_scalar('L1loss', l1_loss)
     return l1_loss
 
 def reconstruction_loss_MSE(inputs, reconstruction):
@@ -615,11 +670,8 @@ def reconstruction_loss_MSE(inputs, reconstruction):
   """
   with tf.name_scope('reconstruction_loss_MSE'):
     # Reconstruction loss
-    mse_loss=tf.keras.losses.MSE(
-                                  reconstruction,
-                                  inputs,
-                                )
-    tf.summary.scalar('MSE_loss', mse_loss)
+    mse_loss=_squared_error(inputs, reconstruction)
+    _maybe_scalar('MSE_loss', mse_loss)
     return mse_loss
 
 def reconstruction_loss_BCE(inputs, reconstruction, pos_weight=1.):
@@ -627,26 +679,21 @@ def reconstruction_loss_BCE(inputs, reconstruction, pos_weight=1.):
   Compute the binary cross-entropy (BCE) loss for reconstruction.
 
   This function computes the BCE loss for the reconstruction of inputs and reconstruction.
+  The BCE is computed in the logits space for numerical stability, reconstruction must then be logits, not sigmoid outputs.
 
   :param inputs: The input tensor.
-  :param reconstruction: The reconstructed tensor.
+  :param reconstruction: The reconstructed tensor logits.
   :param pos_weight: The weight to assign to the positive class in the BCE loss. Default is 1.
 
   :return: The computed BCE loss.
   """
   with tf.name_scope('reconstruction_loss_BCE'):
-    inputs_flat = tf.layers.flatten(inputs)
-    reconstruction_flat = tf.layers.flatten(reconstruction)
-    """xcross_loss=tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits( targets=inputs_flat,
-                                              logits=reconstruction_flat,
-                                              pos_weight=pos_weight))
-
-    xcross_loss=tf.reduce_mean(xcross_loss)
-    """
-    xcross_loss=tf.reduce_mean(K.binary_crossentropy(inputs_flat,reconstruction_flat))
+    if pos_weight == 1.:
+      xcross_loss=_flat_xcross(inputs, reconstruction)
+    else:
+      xcross_loss=_flat_weighted_xcross(inputs, reconstruction, pos_weight=pos_weight, scale=1.)
 
-    tf.summary.scalar('reconstruction_loss_BCE', xcross_loss)
-    #xcross_loss=tf.Print(xcross_loss, [xcross_loss], message='xcross_loss')
+    _maybe_scalar('reconstruction_loss_BCE', xcross_loss)
     return xcross_loss
 
 def reconstruction_loss_BCE_soft(inputs, reconstruction, w=0.8):
@@ -654,26 +701,19 @@ def reconstruction_loss_BCE_soft(inputs, reconstruction, w=0.8):
   Compute the binary cross-entropy (BCE) loss with soft labels for reconstruction.
 
   This function computes the BCE loss with soft labels for the reconstruction of inputs and reconstruction.
+  The BCE is computed in the logits space for numerical stability, reconstruction must then be logits, not sigmoid outputs.
 
   :param inputs: The input tensor.
-  :param reconstruction: The reconstructed tensor.
+  :param reconstruction: The reconstructed tensor logits.
   :param w: The weight for balancing the loss between white and non-white pixels. Default is 0.8.
 
   :return: The computed BCE loss with soft labels.
   """
   with tf.name_scope('reconstruction_loss_BCE_soft'):
-    inputs_flat = tf.layers.flatten(inputs)
-    reconstruction_flat = tf.layers.flatten(reconstruction)
-
-    # handmade binary cross entropy loss taking into account the lower representation of the white pixels
-    xcross_loss=-tf.reduce_mean(w * inputs_flat * tf.math.log(reconstruction_flat + 1e-8),
-                                         reduction_indices=[1]) - \
-                         tf.reduce_mean(
-                             (1 - w) * (1 - inputs_flat) * tf.math.log(1 - reconstruction_flat + 1e-8),
-                             reduction_indices=[1])
-
-    xcross_loss=tf.reduce_mean(xcross_loss)
-    tf.summary.scalar('reconstruction_loss_BCE_soft', xcross_loss)
+    # binary cross entropy loss taking into account the lower representation of the white pixels:
+    # w*x*log(p) and (1-w)*(1-x)*log(1-p) terms are obtained weighting the positive term by w/(1-w)
+    xcross_loss=_flat_weighted_xcross(inputs, reconstruction, pos_weight=w/(1. - w), scale=1. - w)
+    _maybe_scalar('reconstruction_loss_BCE_soft', xcross_loss)
 
     return xcross_loss
 
@@ -694,7 +734,7 @@ def kl_loss(z_mean, logvar, id):
     # KL Divergence loss
     kl_div_loss = 1. + logvar - tf.square(z_mean) - tf.exp(logvar)
     kl_div_loss = tf.reduce_mean(-0.5 * tf.reduce_mean(kl_div_loss, 1))
-    tf.summary.scalar('VAE_kl_loss_'+str(id), kl_div_loss)
+    _maybe_scalar('VAE_kl_loss_'+str(id), kl_div_loss)
     #raw_input('VAE_kl_loss:'+str(kl_div_loss))
     return kl_div_loss
 
@@ -709,22 +749,26 @@ def generateTheta(L,endim):
 
   :return: Generated random samples from the unit (endim)-dimensional space.
   """
-  theta=[w/np.sqrt((w**2).sum()) for w in np.random.normal(size=(L,endim))]
-  return np.asarray(theta, dtype=np.float32)
+  theta=np.random.standard_normal((L,endim)).astype(np.float32)
+  theta/=np.linalg.norm(theta, axis=1, keepdims=True)
+  return theta
 
-def generateZ_ring(batchsize):
+def generateZ_ring(batchsize, r=1., noise=.01):
   """
   Generate samples from a ring distribution in a 2-dimensional space.
 
-  This function generates 2D samples from a ring distribution in a 2-dimensional space.
+  This function generates 2D samples uniformly distributed on a circle of radius r with an additional gaussian noise
+  (same distribution as the outer circle of sklearn.datasets.make_circles for the default values).
 
   :param batchsize: The number of samples to generate.
+  :param r: The ring radius (default: 1).
+  :param noise: The standard deviation of the gaussian noise added to the samples (default: 0.01).
 
   :return: Generated samples from the ring distribution.
   """
-  from sklearn.datasets import make_circles
-  temp=make_circles(2*batchsize,noise=.01)
-  return np.squeeze(temp[0][np.argwhere(temp[1]==0),:]).astype(np.float32)
+  t=(2*np.pi*np.random.uniform(size=(batchsize))).astype(np.float32)
+  jitter=np.random.normal(scale=noise, size=(batchsize, 2)).astype(np.float32)
+  return np.stack([r*np.cos(t), r*np.sin(t)], axis=-1)+jitter
 
 def generateZ_circle(batchsize):
   """
@@ -736,42 +780,44 @@ def generateZ_circle(batchsize):
 
   :return: Generated samples from the circle distribution.
   """
-  r=np.random.uniform(size=(batchsize))
-  theta=2*np.pi*np.random.uniform(size=(batchsize))
-  x=r*np.cos(theta)
-  y=r*np.sin(theta)
-  z_=np.array([x,y], dtype=np.float32).T
-  return z_
+  r=np.random.uniform(size=(batchsize)).astype(np.float32)
+  theta=(2*np.pi*np.random.uniform(size=(batchsize))).astype(np.float32)
+  return np.stack([r*np.cos(theta), r*np.sin(theta)], axis=-1)
 
-def slicedWasserteinLoss_single(code, target_z, sample_points, batch_size):
+@tf.function(jit_compile=True)
+def sorted_projections_squared_distance(projae, projz_sorted):
   """
-  Calculate the Sliced Wasserstein loss for a single code.
+  Compute the mean squared distance between the sorted projections of two sample sets.
 
-  This function computes the Sliced Wasserstein loss for a single code based on the given target z samples and sample points.
+  Encoded samples projections are sorted along the samples axis and compared to the already sorted target
+  projections within a single XLA compiled kernel.
 
-  :param code: The code for which to calculate the loss.
-  :param target_z: The target z samples.
-  :param sample_points: The sample points for projection.
-  :param batch_size: The batch size.
+  :param projae: The projections of the encoded samples, shape [batchsize, L] or [codes, batchsize, L] for a stack of codes.
+  :param projz_sorted: The projections of the target samples sorted along the samples axis, shape [batchsize, L].
 
-  :return: The Sliced Wasserstein loss for the single code.
-  """
-  # Let projae be the projection of the encoded samples
-  projae=tf.matmul(code,tf.transpose(sample_points))
-  # Let projz be the projection of the $q_Z$ samples
-  #projz=K.dot(target_z,K.transpose(sample_points))
-  projz=tf.matmul(target_z,tf.transpose(sample_points))
-  #projz=tf.Print(projz, [projz, projz_tf], message='k vc tf')
-  # Calculate the Sliced Wasserstein distance by sorting
-  # the projections and calculating the L2 distance between
-  W2=(tf.nn.top_k(tf.transpose(projae),k=batch_size).values-tf.nn.top_k(tf.transpose(projz),k=batch_size).values)**2
-  #W2=tf.Print(W2, [tf.nn.top_k(tf.transpose(projae),k=batch_size).values[0]], message='sorted projae', summarize=10)
-  w2weight=tf.Variable(tf.constant(10.0), trainable=False)
-  tf.summary.scalar('W2_weight', w2weight)
-  W2Loss= w2weight*tf.reduce_mean(W2)
-  return W2Loss
+  :return: The float32 mean squared distance between the sorted projections (one value per code for a stack of codes).
+  """
+  W2=tf.cast(tf.math.squared_difference(tf.sort(projae, axis=-2), projz_sorted), tf.float32)
+  return tf.reduce_mean(W2, axis=[-2, -1])
 
-def swae_loss(code_list, target_z, batch_size, L=50):
+@tf.function(jit_compile=True)
+def sliced_wasserstein_distances(codes, target_z, theta_t):
+  """
+  Compute the sliced Wasserstein distances of a stack of codes to the target samples within a single XLA compiled kernel.
+
+  :param codes: The stacked codes, shape [codes, batchsize, codeDim].
+  :param target_z: The target z samples, shape [batchsize, codeDim].
+  :param theta_t: The transposed sample points for projection, shape [codeDim, L], the codes and target samples are projected in its dtype.
+
+  :return: The float32 distance of each code.
+  """
+  # Let projz be the projection of the $q_Z$ samples, shared by all the codes
+  projz_sorted=tf.sort(tf.matmul(tf.cast(target_z, theta_t.dtype), theta_t), axis=0)
+  # project all the codes at once
+  projae=tf.einsum('ncd,dl->ncl', tf.cast(codes, theta_t.dtype), theta_t)
+  return sorted_projections_squared_distance(projae, projz_sorted)
+
+def swae_loss(code_list, target_z, batch_size, L=50, projections_dtype=tf.float32):
   """
   Calculate the Sliced Wasserstein Autoencoder (AE) loss.
 
@@ -781,6 +827,7 @@ def swae_loss(code_list, target_z, batch_size, L=50):
   :param target_z: The target z samples.
   :param batch_size: The batch size.
   :param L: The number of sample points to project on (default: 50).
+  :param projections_dtype: The dtype of the projections and sorts, set tf.bfloat16 or tf.float16 to reduce memory traffic on hardware that supports them (default: tf.float32). The loss is accumulated in float32.
 
   :return: The Sliced Wasserstein Autoencoder (AE) loss.
   """
@@ -789,21 +836,16 @@ def swae_loss(code_list, target_z, batch_size, L=50):
     raise ValueError('swae_loss error : input code list is empty')
   if len(code_list[0].shape)!=2:
     raise ValueError('swae_loss error : input codes must be flat codes of size batchsize*codeDim')
-  #generate two variables used for the loss at the current iteration
-  #theta=tf.Variable(tf.ones(generateTheta(L,code_list[0].shape[-1]).shape), trainable=False) #Define a Keras Variable for \theta_ls
-  #theta=tf.Print(theta, [theta], message='theta')
-  #target_z=tf.Variable(tf.ones(target_z_samples.shape), trainable=False) #Define a Keras Variable for samples of z)
-  theta=tf.numpy_function(generateTheta,[L, code_list[0].shape[-1]], tf.float32)
-  #theta=tf.Print(theta, [theta, target_z], message='theta, target_z')
-
-  loss=0
-  for id, code in code_list:#enumerate(tf.get_collection('codes')):
-    W2Loss = slicedWasserteinLoss_single(code, target_z, theta, batch_size)
-    tf.summary.scalar('w2loss_'+str(id), W2Loss)
-    print('W2Loss='+str(W2Loss))
-    loss+=W2Loss
-  #loss=tf.Print(loss, [loss], message='SWAE')
-  return loss
+  # draw L random directions on the unit sphere of the codes space, directly within the graph
+  # and in their transposed [codeDim, L] layout used for projection
+  theta_t=tf.math.l2_normalize(tf.random.normal([code_list[0].shape[-1], L], dtype=tf.float32), axis=0)
+  theta_t=tf.cast(theta_t, projections_dtype)
+  w2weight=tf.Variable(tf.constant(10.0), trainable=False)
+  _maybe_scalar('W2_weight', w2weight)
+  W2Losses=w2weight*sliced_wasserstein_distances(tf.stack(code_list, axis=0), target_z, theta_t)
+  with _summaries_recording(every=100):
+    tf.summary.histogram('w2losses', W2Losses)
+  return tf.reduce_sum(W2Losses)
 
 def discrepancy_slice_wasserstein(p1, p2):
   """
@@ -827,9 +869,8 @@ def discrepancy_slice_wasserstein(p1, p2):
 
     :return: The sorted matrix.
     """
-    matrix_T = tf.transpose(matrix, [1, 0])
-    sorted_matrix_T = tf.nn.top_k(matrix_T, num_rows)[0]
-    return tf.transpose(sorted_matrix_T, [1, 0])
+    # sort along the rows axis directly, without transposing back and forth
+    return tf.sort(matrix, axis=0, direction='DESCENDING')[:num_rows]
   s = tf.shape(p1)
   if p1.get_shape().as_list()[1] > 1:
       # For data more than one-dimensional, perform multiple random projection to 1-D
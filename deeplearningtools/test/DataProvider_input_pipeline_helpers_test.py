@@ -0,0 +1,197 @@
+''' unit tests of the DataProvider_input_pipeline helpers, each batched/fused helper is compared
+to the per crop or per sample processing it replaces, on fixed inputs.
+
+Run from the project root folder : python -m pytest deeplearningtools/test/DataProvider_input_pipeline_helpers_test.py
+'''
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from deeplearningtools import DataProvider_input_pipeline
+
+def reference_samples_entropies(samples_batch):
+  ''' per sample normalized entropies, one np.unique call per sample '''
+  flatten_samples=np.reshape(samples_batch, [samples_batch.shape[0], -1])
+  entropies=np.zeros(samples_batch.shape[0], dtype=np.float32)
+  for it, sample in enumerate(flatten_samples):
+    counts=np.unique(sample, return_counts=True)[1]
+    if len(counts)==1:
+      continue
+    classes_prob=counts/float(len(sample))
+    entropies[it]=-(classes_prob*np.log(classes_prob)).sum()/np.log(float(len(counts)))
+  return entropies
+
+def get_labels_samples(nb_samples, seed=0):
+  ''' fixed label maps : random ids (including negative ones), a single class sample and a two classes sample '''
+  rng=np.random.default_rng(seed)
+  samples=rng.integers(-2, 6, size=[nb_samples, 8, 8, 1])
+  samples[0]=3
+  samples[1, :4]=1
+  samples[1, 4:]=5
+  return samples
+
+def test_crops_filter_has_no_control_flow(tmp_path):
+  # the fused crops filter must evaluate the built-in filters (nan avoidance and labels entropy)
+  # on all the crops at once, without any per crop or per filter control flow
+  raw_files, ref_files=[], []
+  for id in range(2):
+    raw_files.append(str(tmp_path/('raw_'+str(id)+'.png')))
+    ref_files.append(str(tmp_path/('ref_'+str(id)+'.png')))
+    tf.io.write_file(raw_files[-1], tf.io.encode_png(tf.cast(tf.random.uniform([64, 64, 3], maxval=256, dtype=tf.int32), tf.uint8)))
+    tf.io.write_file(ref_files[-1], tf.io.encode_png(tf.cast(tf.random.uniform([64, 64, 1], maxval=3, dtype=tf.int32), tf.uint8)))
+  data_provider=DataProvider_input_pipeline.FileListProcessor_Semantic_Segmentation(raw_files, ref_files,
+                                                                                     nbEpoch=1,
+                                                                                     batch_size=2,
+                                                                                     use_alternative_imread=None,
+                                                                                     balance_classes_distribution=True,
+                                                                                     classes_entropy_threshold=0.3,
+                                                                                     manage_nan_values='avoid')
+  filter_fn=data_provider.crop_filter_fn.get_concrete_function(tf.TensorSpec([None]+list(data_provider.cropSize), tf.float32))
+  graph_def=filter_fn.graph.as_graph_def()
+  ops=set(node.op for node in graph_def.node)
+  for function in graph_def.library.function:
+    ops.update(node.op for node in function.node_def)
+  assert data_provider.nb_filters==2
+  assert ops.isdisjoint({'While', 'StatelessWhile', 'If', 'StatelessIf'}), ops
+
+def test_get_crops_filter():
+  crops=tf.constant(np.random.default_rng(0).uniform(size=[6, 4, 4, 2]), dtype=tf.float32)
+  crop_filter=lambda crop: tf.reduce_mean(crop[:,:,0])>tf.reduce_mean(crop[:,:,1])
+  expected=[bool(crop_filter(crop)) for crop in crops]
+  np.testing.assert_array_equal(DataProvider_input_pipeline.get_crops_filter(crop_filter)(crops).numpy(), expected)
+
+def test_compose_image_transforms():
+  images=tf.constant(np.random.default_rng(0).uniform(size=[3, 5, 4, 2]), dtype=tf.float32)
+  seeds=tf.constant([[1, 2], [3, 4], [5, 6]], dtype=tf.int32)
+  transforms=[tf.image.stateless_random_flip_left_right,
+              lambda img, seed: img*2.0+1.0,
+              tf.image.stateless_random_flip_up_down]
+  for jit_compile in [False, True]:
+    # reference : the transforms applied one after the other (XLA draws other stateless random values than the CPU kernels)
+    expected=images
+    for transform, seed in zip(transforms, seeds):
+      expected=tf.function(transform, jit_compile=jit_compile)(expected, seed)
+    composed=DataProvider_input_pipeline.compose_image_transforms(transforms, jit_compile=jit_compile)
+    np.testing.assert_allclose(composed(images, seeds).numpy(), expected.numpy())
+
+def test_get_sample_entropies_int_batched():
+  samples=get_labels_samples(5)*50 # values out of the [0, 255] range are counted in the border bins
+  expected=[DataProvider_input_pipeline.get_sample_entropy_int(tf.constant(sample)).numpy() for sample in samples]
+  batched=DataProvider_input_pipeline.get_sample_entropies_int_batched(tf.constant(samples))
+  np.testing.assert_allclose(batched.numpy(), expected, rtol=1e-5, atol=1e-6)
+  # empty batches are supported
+  assert DataProvider_input_pipeline.get_sample_entropies_int_batched(tf.zeros([0, 8, 8, 1])).shape==[0]
+
+@pytest.mark.parametrize('nb_samples', [5, DataProvider_input_pipeline.numba_entropies_min_batch_size+3])
+def test_get_samples_entropies(nb_samples):
+  # small batches : numpy bincount version, large batches : numba version if available
+  samples=get_labels_samples(nb_samples)
+  expected=reference_samples_entropies(samples)
+  np.testing.assert_allclose(DataProvider_input_pipeline.get_samples_entropies(samples), expected, rtol=1e-5, atol=1e-6)
+  np.testing.assert_allclose(DataProvider_input_pipeline.get_samples_entropies_tf(tf.constant(samples)).numpy(), expected, rtol=1e-5, atol=1e-6)
+
+def test_samples_entropies_numba():
+  if DataProvider_input_pipeline.numba is None:
+    pytest.skip('numba is not available')
+  samples=get_labels_samples(7)
+  flatten_samples=np.reshape(samples, [samples.shape[0], -1]).astype(np.int64)
+  flatten_samples-=flatten_samples.min()
+  entropies=DataProvider_input_pipeline._samples_entropies_numba(flatten_samples, int(flatten_samples.max())+1)
+  np.testing.assert_allclose(entropies, reference_samples_entropies(samples), rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize('extension, image_shape, image_dtype', [('.png', [6, 5, 3], np.uint8),
+                                                                 ('.png', [6, 5], np.uint16),
+                                                                 ('.tif', [6, 5, 3], np.uint8)])
+def test_imread_with_fallback(tmp_path, extension, image_shape, image_dtype):
+  cv2=pytest.importorskip('cv2')
+  filename=str(tmp_path/('image'+extension))
+  image=np.random.default_rng(0).integers(0, np.iinfo(image_dtype).max, size=image_shape, dtype=image_dtype)
+  cv2.imwrite(filename, image)
+  # reference : the python reader used for all the formats
+  expected=DataProvider_input_pipeline.imread_from_opencv(filename.encode('utf-8'), -1)
+  expected=np.reshape(expected, expected.shape[:2]+(-1,))
+  fallback_imread_fn=DataProvider_input_pipeline.get_imread_fallback_fn('opencv', -1)
+  imread_fn=tf.function(lambda filename: DataProvider_input_pipeline.imread_with_fallback(filename, fallback_imread_fn))
+  np.testing.assert_array_equal(imread_fn(tf.constant(filename)).numpy(), expected)
+  # eager call, the fallback reader then receives a 0-d numpy array filename
+  image_read=DataProvider_input_pipeline.imread_with_fallback(tf.constant(filename), fallback_imread_fn)
+  np.testing.assert_array_equal(image_read.numpy(), expected)
+
+@pytest.mark.parametrize('shuffle', [False, True])
+# whole files, whole files larger than the size limit (read by lines windows if windows overlap), lines windows
+@pytest.mark.parametrize('read_whole_files, read_whole_files_max_size', [(True, 32<<20), (True, 0), (False, 32<<20)])
+@pytest.mark.parametrize('windowing_shift', [3, 8])
+def test_csv_time_series_windows(tmp_path, read_whole_files, read_whole_files_max_size, windowing_shift, shuffle):
+  temporal_series_length=8
+  rows=np.arange(40*3, dtype=np.float32).reshape([40, 3])
+  filename=str(tmp_path/'series.csv')
+  with open(filename, 'w') as csv_file:
+    csv_file.write('label,a,b\n')
+    csv_file.writelines(','.join(str(value) for value in row)+'\n' for row in rows)
+  # reference : each window of rows read one at a time, as [C, T] samples
+  windows=[rows[start:start+temporal_series_length].T for start in range(0, len(rows)-temporal_series_length+1, windowing_shift)]
+  dataset=DataProvider_input_pipeline.FileListProcessor_csv_time_series(files=[filename],
+                                                                        csv_field_delim=',',
+                                                                        record_defaults_values=[[0.0]]*3,
+                                                                        batch_size=1,
+                                                                        epochs=1,
+                                                                        temporal_series_length=temporal_series_length,
+                                                                        windowing_shift=windowing_shift,
+                                                                        labels_cols_nb=1,
+                                                                        shuffle=shuffle,
+                                                                        read_whole_files=read_whole_files,
+                                                                        read_whole_files_max_size=read_whole_files_max_size)
+  samples=list(dataset.as_numpy_iterator())
+  if shuffle: # same samples, back in the file order
+    samples=sorted(samples, key=lambda sample: sample[1][0,0,0])
+  assert len(samples)==len(windows)
+  for (raw_data, labels), window in zip(samples, windows):
+    np.testing.assert_array_equal(labels[0], window[:1])
+    np.testing.assert_array_equal(raw_data[0], window[1:])
+
+def test_test_mode_crops_grid(tmp_path):
+  # test mode crops : same grid and order as the former per box crop_to_bounding_box calls
+  patch_size, field_of_view=16, 5
+  image=np.random.default_rng(0).integers(0, 256, size=[64, 80, 3], dtype=np.uint8)
+  label=np.random.default_rng(1).integers(0, 3, size=[64, 80, 1], dtype=np.uint8)
+  raw_file, ref_file=str(tmp_path/'raw.png'), str(tmp_path/'ref.png')
+  tf.io.write_file(raw_file, tf.io.encode_png(image))
+  tf.io.write_file(ref_file, tf.io.encode_png(label))
+  data_provider=DataProvider_input_pipeline.FileListProcessor_Semantic_Segmentation([raw_file], [ref_file],
+                                                                                     nbEpoch=1,
+                                                                                     shuffle_samples=False,
+                                                                                     patch_ratio_vs_input=patch_size,
+                                                                                     field_of_view=field_of_view,
+                                                                                     apply_random_flip_left_right=False,
+                                                                                     apply_random_brightness=None,
+                                                                                     apply_random_saturation=None,
+                                                                                     apply_random_contrast=None,
+                                                                                     apply_whitening=False,
+                                                                                     batch_size=1,
+                                                                                     use_alternative_imread=None,
+                                                                                     dtype=tf.float32)
+  stride=patch_size-2*((field_of_view-1)//2)
+  sample=np.concatenate([image, label], axis=2)
+  expected=[sample[top:top+patch_size, left:left+patch_size] for left in range(0, 80-patch_size, stride) for top in range(0, 64-patch_size, stride)]
+  crops=[batch[0] for batch in data_provider.dataset.as_numpy_iterator()]
+  assert len(crops)==len(expected)
+  np.testing.assert_array_equal(np.stack(crops), np.stack(expected))
+
+def test_csv_time_series_cache_dir(tmp_path):
+  # the cache folder is created if missing, the cached samples are replayed at each epoch
+  filename=str(tmp_path/'series.csv')
+  with open(filename, 'w') as csv_file:
+    csv_file.write('label,a\n')
+    csv_file.writelines('{id},{value}\n'.format(id=id, value=2*id) for id in range(20))
+  cache_dir=tmp_path/'cache'/'csv'
+  dataset=DataProvider_input_pipeline.FileListProcessor_csv_time_series(files=[filename],
+                                                                        csv_field_delim=',',
+                                                                        record_defaults_values=[[0.0]]*2,
+                                                                        batch_size=1,
+                                                                        epochs=2,
+                                                                        temporal_series_length=5,
+                                                                        windowing_shift=5,
+                                                                        labels_cols_nb=1,
+                                                                        cache_dir=str(cache_dir))
+  assert len(list(dataset.as_numpy_iterator()))==2*4
+  assert len(list(cache_dir.iterdir()))>0
@@ -116,9 +116,6 @@ def _bytes_feature(value):
     value = value.numpy() # BytesList won't unpack a string from an EagerTensor.
   return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-def _float_feature_list(value):
-  """Returns a float_list from a float / double."""
-  return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
 def _int64_feature_scalar(value):
   """Returns an int64_list from a bool / enum / int / uint."""
@@ -133,7 +130,7 @@ def image_example(image_tensor, label=None):
       'height': _int64_feature_scalar(image_shape[0]),
       'width': _int64_feature_scalar(image_shape[1]),
       'depth': _int64_feature_scalar(image_shape[2]),
-      'image_raw': _float_feature_list(image_tensor.numpy().flatten().tolist()),
+      'image_raw': _bytes_feature(image_tensor.numpy().astype(np.float32).tobytes()),
   }
   if label is not None:
     feature.update({'label': _int64_feature_scalar(label)})